@@ -1,14 +1,16 @@
 import os
 import argparse
+import hashlib
 import numpy as np
 import pandas as pd
 from scipy import sparse
-from collections import defaultdict
+from multiprocessing import Pool
 from sklearn.preprocessing import OneHotEncoder
 
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
+from utils.data import COLUMN_DTYPES, get_user_offsets, load_preprocessed, save_encoded
 from utils.queue import TimeWindowQueue
 
 
@@ -18,172 +20,442 @@ def phi(x):
 
 WINDOW_LENGTHS = [3600 * 24 * 30, 3600 * 24 * 7, 3600 * 24, 3600]
 NUM_WINDOWS = len(WINDOW_LENGTHS) + 1
+COUNTERS = ['sc', 'ic', 'tc']
 
 
-def df_to_sparse(df, Q_mat, active_features):
-    """Build sparse dataset from dense dataset and q-matrix.
+def get_past_counts(keys, weights=None):
+    """For each position, sum of weights (1 by default) at previous positions with the same key."""
+    weights = np.ones(len(keys)) if weights is None else weights.astype(float)
+    return pd.Series(weights).groupby(keys).cumsum().values - weights
+
+
+def count_in_windows(groups, times, events=None):
+    """Count previous events of the same group, in total and within each time window.
+
+    Vectorized equivalent of a time window queue per group, read before pushing each event.
+    Times must be sorted within each group.
 
     Arguments:
-        df (pandas DataFrame): output by prepare_data.py
-        Q_mat (sparse array): q-matrix, output by prepare_data.py
-        active_features (list of str): features
+        groups (array of int): group of each row
+        times (array of int): time of each row
+        events (array of bool): rows that are pushed as events, all rows if None
 
     Output:
-        sparse_df (sparse array): sparse dataset where first 5 columns are the same as in df
+        counts (numpy array): (num_rows, NUM_WINDOWS) total count followed by one count per window
     """
-    num_items, num_skills = Q_mat.shape
-    features = {}
+    groups = pd.factorize(groups)[0].astype(np.int64)
+    events = np.ones(len(groups), dtype=bool) if events is None else events.astype(bool)
+    counts = np.empty((len(groups), NUM_WINDOWS))
+    counts[:, 0] = get_past_counts(groups, events)
 
-    # Counters for continuous time windows
-    counters = defaultdict(lambda: TimeWindowQueue(WINDOW_LENGTHS))
+    # Events sorted by (group, time) in a single array of keys, with times shifted so that
+    # every window start is nonnegative
+    times = times.astype(np.int64) - times.min() + max(WINDOW_LENGTHS)
+    span = times.max() + 1
+    event_keys = np.sort(groups[events] * span + times[events])
+    group_starts = np.searchsorted(event_keys, groups * span, side="left")
 
-    # Transform q-matrix into dictionary for fast lookup
-    Q_mat_dict = {i: set() for i in range(num_items)}
-    for i, j in np.argwhere(Q_mat == 1):
-        Q_mat_dict[i].add(j)
+    # Events at least one window length old fall out of the window
+    for w, length in enumerate(WINDOW_LENGTHS):
+        num_old = np.searchsorted(event_keys, groups * span + times - length, side="right") - group_starts
+        counts[:, w + 1] = counts[:, 0] - num_old
+    return counts
 
-    # Keep track of original dataset
-    features['df'] = np.empty((0, len(df.keys())))
 
-    # Skill features
-    if 's' in active_features:
-        features["s"] = sparse.csr_matrix(np.empty((0, num_skills)))
+def count_past(groups, times, events, windows):
+    """Count previous events of the same group, within time windows if windows is True.
+
+    Output:
+        counts (numpy array): (num_rows, NUM_WINDOWS) if windows else (num_rows, 1)
+    """
+    if windows:
+        return count_in_windows(groups, times, events)
+    return get_past_counts(groups, events)[:, None]
+
+
+def counts_to_csr(rows, cols, counts, shape):
+    """Assemble phi of counts into a sparse matrix, counts[k][:, w] going to (rows[k], cols[k] + w).
+
+    Arguments:
+        rows, cols (list of array of int): row and first column of each group of counts
+        counts (list of numpy array): (len(rows[k]), num_windows) counts
+        shape (tuple of int): matrix shape
+    """
+    if len(counts) == 0:
+        return sparse.csr_matrix(shape)
+    num_windows = counts[0].shape[1]
+    rows = np.concatenate([np.repeat(r, num_windows) for r in rows])
+    cols = np.concatenate([(c[:, None] + np.arange(num_windows)).ravel() for c in cols])
+    vals = phi(np.concatenate([c.ravel() for c in counts]))
+    nonzero = vals != 0
+    return sparse.csr_matrix((vals[nonzero], (rows[nonzero], cols[nonzero])), shape=shape)
+
+
+def get_block_names(active_features):
+    """Names of the feature blocks making up the columns of X, in order.
 
-    # Past attempts and wins features
+    Past attempts and wins are split by counter, e.g. "a-sc-tw" holds past attempts for
+    relevant skills in time windows, so that every block only depends on its own name.
+    """
+    suffix = "-tw" if 'tw' in active_features else ""
+    names = ['s'] if 's' in active_features else []
     for key in ['a', 'w']:
         if key in active_features:
-            if 'tw' in active_features:
-                features[key] = sparse.csr_matrix(np.empty((0, (num_skills + 2) * NUM_WINDOWS)))
-            else:
-                features[key] = sparse.csr_matrix(np.empty((0, num_skills + 2)))
+            names += [f"{key}-{counter}{suffix}" for counter in COUNTERS if counter in active_features]
+    return names + [x for x in ['u', 'i'] if x in active_features]
+
+
+def get_block_width(name, num_skills):
+    """Number of columns of a past attempts or wins block."""
+    key, counter, *windows = name.split("-")
+    num_windows = NUM_WINDOWS if windows else 1
+    return num_skills * num_windows if counter == 'sc' else num_windows
+
 
-    # Build feature rows by iterating over users
-    for user_id in df["user_id"].unique():
-        df_user = df[df["user_id"] == user_id][["user_id", "item_id", "timestamp", "correct", "skill_id"]].copy()
-        df_user = df_user.values
-        num_items_user = df_user.shape[0]
+def encode_users(data, offsets, Q_mat, block_names):
+    """Build the skill, attempts and wins feature blocks of consecutive user sequences.
 
-        skills = Q_mat[df_user[:, 1].astype(int)].copy()
+    Blocks are emitted directly as sparse triplets, so memory scales with the number of nonzero
+    entries rather than with rows x skills x windows.
 
-        features['df'] = np.vstack((features['df'], df_user))
+    Arguments:
+        data (numpy array): user_id, item_id, timestamp, correct and skill_id columns,
+            contiguous per user
+        offsets (array of int): user sequence offsets in data, see utils.data.get_user_offsets
+        Q_mat (sparse array): q-matrix
+        block_names (list of str): blocks to build among s and the past attempts and wins
+            blocks, see get_block_names
+
+    Output:
+        features (dict of sparse array): one csr matrix per block
+    """
+    num_items, num_skills = Q_mat.shape
+    num_rows = len(data)
+    features = {}
 
-        item_ids = df_user[:, 1].reshape(-1, 1)
-        labels = df_user[:, 3].reshape(-1, 1)
+    item_ids, times, labels = data[:, 1].astype(int), data[:, 2], data[:, 3]
+    user_idxs = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    all_rows = np.arange(num_rows)
 
+    # One (row, skill) pair per skill of each interaction
+    skills = sparse.csr_matrix(Q_mat)[item_ids]
+    pair_rows, pair_skills = skills.nonzero()
+
+    for name in block_names:
         # Current skills one hot encoding
-        if 's' in active_features:
-            features['s'] = sparse.vstack([features["s"], sparse.csr_matrix(skills)])
-
-        # Attempts
-        if 'a' in active_features:
-            # Time windows
-            if 'tw' in active_features:
-                attempts = np.zeros((num_items_user, (num_skills + 2) * NUM_WINDOWS))
-
-                for i, (item_id, ts) in enumerate(df_user[:, 1:3]):
-                    # Past attempts for relevant skills
-                    if 'sc' in active_features:
-                        for skill_id in Q_mat_dict[item_id]:
-                            counts = phi(np.array(counters[user_id, skill_id, "skill"].get_counters(ts)))
-                            attempts[i, skill_id * NUM_WINDOWS:(skill_id + 1) * NUM_WINDOWS] = counts
-                            counters[user_id, skill_id, "skill"].push(ts)
-
-                    # Past attempts for item
-                    if 'ic' in active_features:
-                        counts = phi(np.array(counters[user_id, item_id, "item"].get_counters(ts)))
-                        attempts[i, -2 * NUM_WINDOWS:-1 * NUM_WINDOWS] = counts
-                        counters[user_id, item_id, "item"].push(ts)
-
-                    # Past attempts for all items
-                    if 'tc' in active_features:
-                        counts = phi(np.array(counters[user_id].get_counters(ts)))
-                        attempts[i, -1 * NUM_WINDOWS:] = counts
-                        counters[user_id].push(ts)
-
-            # Counts
-            else:
-                attempts = np.zeros((num_items_user, num_skills + 2))
-
-                # Past attempts for relevant skills
-                if 'sc' in active_features:
-                    tmp = np.vstack((np.zeros(num_skills), skills))[:-1]
-                    attempts[:, :num_skills] = phi(np.cumsum(tmp, 0) * skills)
-
-                # Past attempts for item
-                if 'ic' in active_features:
-                    onehot = OneHotEncoder(n_values=df_user[:, 1].max() + 1)
-                    item_ids_onehot = onehot.fit_transform(item_ids).toarray()
-                    tmp = np.vstack((np.zeros(item_ids_onehot.shape[1]), np.cumsum(item_ids_onehot, 0)))[:-1]
-                    attempts[:, -2] = phi(tmp[np.arange(num_items_user), df_user[:, 1]])
-
-                # Past attempts for all items
-                if 'tc' in active_features:
-                    attempts[:, -1] = phi(np.arange(num_items_user))
-
-            features['a'] = sparse.vstack([features['a'], sparse.csr_matrix(attempts)])
-
-        # Wins
-        if "w" in active_features:
-            # Time windows
-            if 'tw' in active_features:
-                wins = np.zeros((num_items_user, (num_skills + 2) * NUM_WINDOWS))
-
-                for i, (item_id, ts, correct) in enumerate(df_user[:, 1:4]):
-                    # Past wins for relevant skills
-                    if 'sc' in active_features:
-                        for skill_id in Q_mat_dict[item_id]:
-                            counts = phi(np.array(counters[user_id, skill_id, "skill", "correct"].get_counters(ts)))
-                            wins[i, skill_id * NUM_WINDOWS:(skill_id + 1) * NUM_WINDOWS] = counts
-                            if correct:
-                                counters[user_id, skill_id, "skill", "correct"].push(ts)
-
-                    # Past wins for item
-                    if 'ic' in active_features:
-                        counts = phi(np.array(counters[user_id, item_id, "item", "correct"].get_counters(ts)))
-                        wins[i, -2 * NUM_WINDOWS:-1 * NUM_WINDOWS] = counts
-                        if correct:
-                            counters[user_id, item_id, "item", "correct"].push(ts)
-
-                    # Past wins for all items
-                    if 'tc' in active_features:
-                        counts = phi(np.array(counters[user_id, "correct"].get_counters(ts)))
-                        wins[i, -1 * NUM_WINDOWS:] = counts
-                        if correct:
-                            counters[user_id, "correct"].push(ts)
-
-            # Counts
-            else:
-                wins = np.zeros((num_items_user, num_skills + 2))
-
-                # Past wins for relevant skills
-                if 'sc' in active_features:
-                    tmp = np.vstack((np.zeros(num_skills), skills))[:-1]
-                    corrects = np.hstack((np.array(0), df_user[:, 3])).reshape(-1, 1)[:-1]
-                    wins[:, :num_skills] = phi(np.cumsum(tmp * corrects, 0) * skills)
-
-                # Past wins for item
-                if 'ic' in active_features:
-                    onehot = OneHotEncoder(n_values=df_user[:, 1].max() + 1)
-                    item_ids_onehot = onehot.fit_transform(item_ids).toarray()
-                    tmp = np.vstack((np.zeros(item_ids_onehot.shape[1]), np.cumsum(item_ids_onehot * labels, 0)))[:-1]
-                    wins[:, -2] = phi(tmp[np.arange(num_items_user), df_user[:, 1]])
-
-                # Past wins for all items
-                if 'tc' in active_features:
-                    wins[:, -1] = phi(np.concatenate((np.zeros(1), np.cumsum(df_user[:, 3])[:-1])))
-
-            features['w'] = sparse.vstack([features['w'], sparse.csr_matrix(wins)])
+        if name == 's':
+            features['s'] = skills
+            continue
+
+        key, counter, *windows = name.split("-")
+        events = labels if key == 'w' else None
+        windows = len(windows) > 0
+        num_windows = NUM_WINDOWS if windows else 1
+
+        # Past attempts or wins for relevant skills
+        if counter == 'sc':
+            rows, cols = pair_rows, pair_skills * num_windows
+            counts = count_past(user_idxs[pair_rows] * num_skills + pair_skills, times[pair_rows],
+                                events[pair_rows] if events is not None else None, windows)
+
+        # Past attempts or wins for item
+        elif counter == 'ic':
+            rows, cols = all_rows, np.zeros(num_rows, dtype=int)
+            counts = count_past(user_idxs * num_items + item_ids, times, events, windows)
+
+        # Past attempts or wins for all items
+        elif counter == 'tc':
+            rows, cols = all_rows, np.zeros(num_rows, dtype=int)
+            counts = count_past(user_idxs, times, events, windows)
+
+        features[name] = counts_to_csr([rows], [cols], [counts], (num_rows, get_block_width(name, num_skills)))
+
+    return features
+
+
+def get_data_hash(data, Q_mat):
+    """Hash of the encoded data and q-matrix, identifying cached feature blocks."""
+    Q_mat = sparse.csr_matrix(Q_mat)
+    digest = hashlib.sha1(np.ascontiguousarray(data).tobytes())
+    for array in [Q_mat.indptr, Q_mat.indices, Q_mat.data, np.array(Q_mat.shape)]:
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def df_to_sparse(df, Q_mat, active_features, workers=1, cache_dir=None):
+    """Build sparse dataset from dense dataset and q-matrix.
+
+    Arguments:
+        df (pandas DataFrame): output by prepare_data.py
+        Q_mat (sparse array): q-matrix, output by prepare_data.py
+        active_features (list of str): features
+        workers (int): number of processes encoding disjoint shards of users
+        cache_dir (str): if not None, folder where each feature block is cached, keyed by a hash
+            of the data and by the block name, so that any feature combination reuses them
+
+    Output:
+        X (sparse array): float32 csr feature matrix with int32 indices
+        meta (pandas DataFrame): user_id, item_id, timestamp, correct and skill_id of each row of X
+        column_blocks (pandas DataFrame): name, start and stop column of each feature block of X
+    """
+    num_skills = Q_mat.shape[1]
+
+    # Group rows by user in order of first appearance, keeping the order within each user
+    user_codes = pd.factorize(df["user_id"])[0]
+    order = np.argsort(user_codes, kind="stable")
+    data = df[["user_id", "item_id", "timestamp", "correct", "skill_id"]].values[order]
+    offsets = get_user_offsets(user_codes[order])
+
+    block_names = get_block_names(active_features)
+    features = {}
+
+    # Load cached blocks
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        data_hash = get_data_hash(data, Q_mat)
+        block_paths = {name: os.path.join(cache_dir, f"{data_hash}-{name}.npz") for name in block_names}
+        for name, path in block_paths.items():
+            if os.path.exists(path):
+                features[name] = sparse.load_npz(path).tocsr()
+    missing = [name for name in block_names if name not in features]
+
+    # Shards of whole users with similar numbers of rows, merged back in order
+    user_blocks = [name for name in missing if name not in ['u', 'i']]
+    if user_blocks:
+        bounds = np.unique(np.searchsorted(offsets, np.linspace(0, len(data), workers + 1)))
+        shards = [(data[offsets[i]:offsets[j]], offsets[i:j + 1] - offsets[i], Q_mat, user_blocks)
+                  for i, j in zip(bounds[:-1], bounds[1:])]
+        if workers > 1:
+            with Pool(workers) as pool:
+                shard_features = pool.starmap(encode_users, shards)
+        else:
+            shard_features = [encode_users(*shard) for shard in shards]
+
+        for name in user_blocks:
+            features[name] = sparse.vstack([f[name] for f in shard_features], format="csr")
 
     # User and item one hot encodings
     onehot = OneHotEncoder()
-    if 'u' in active_features:
-        features['u'] = onehot.fit_transform(features["df"][:, 0].reshape(-1, 1))
-    if 'i' in active_features:
-        features['i'] = onehot.fit_transform(features["df"][:, 1].reshape(-1, 1))
+    if 'u' in missing:
+        features['u'] = onehot.fit_transform(data[:, 0].reshape(-1, 1)).tocsr()
+    if 'i' in missing:
+        features['i'] = onehot.fit_transform(data[:, 1].reshape(-1, 1)).tocsr()
+
+    if cache_dir is not None:
+        for name in missing:
+            sparse.save_npz(block_paths[name], features[name])
 
-    X = sparse.hstack([sparse.csr_matrix(features['df']),
-                       sparse.hstack([features[x] for x in features.keys() if x != 'df'])]).tocsr()
-    return X
+    blocks, names = [], []
+    if 's' in active_features:
+        blocks.append(features['s'])
+        names.append('s')
+
+    # Past attempts and wins hold columns for every counter, zero if the counter is not active
+    suffix = "-tw" if 'tw' in active_features else ""
+    for key in ['a', 'w']:
+        if key in active_features:
+            for counter in COUNTERS:
+                name = f"{key}-{counter}{suffix}"
+                if counter in active_features:
+                    blocks.append(features[name])
+                else:
+                    blocks.append(sparse.csr_matrix((len(data), get_block_width(name, num_skills))))
+                names.append(name)
+
+    for name in ['u', 'i']:
+        if name in active_features:
+            blocks.append(features[name])
+            names.append(name)
+
+    # Column range of each block in X
+    widths = np.array([block.shape[1] for block in blocks])
+    column_blocks = pd.DataFrame({"name": names, "start": np.cumsum(widths) - widths, "stop": np.cumsum(widths)})
+
+    X = sparse.hstack(blocks, format="csr", dtype=np.float32)
+    if X.nnz <= np.iinfo(np.int32).max:
+        X.indices, X.indptr = X.indices.astype(np.int32), X.indptr.astype(np.int32)
+
+    # Keep track of original dataset in separate typed columns
+    meta = pd.DataFrame(data, columns=["user_id", "item_id", "timestamp", "correct", "skill_id"])
+    meta = meta.astype({col: dtype for col, dtype in COLUMN_DTYPES.items() if col in meta})
+    return X, meta, column_blocks
+
+
+class OnlineEncoder:
+    """Per-user feature state to encode interactions one at a time for real-time scoring.
+
+    Produces the same feature columns as df_to_sparse from running counts kept in arrays per
+    user, with a timestamp queue per counted group when time windows are used. Encoding and
+    updates cost O(number of skills of the item).
+    """
+    def __init__(self, Q_mat, active_features, user_ids=None, item_ids=None):
+        """
+        Arguments:
+            Q_mat (sparse array): q-matrix, output by prepare_data.py
+            active_features (list of str): features
+            user_ids (array of int): users of the encoded dataset, defining the user one hot
+                columns, unknown users get no user column
+            item_ids (array of int): same for items
+        """
+        self.Q_mat = sparse.csr_matrix(Q_mat)
+        self.Q_mat.sort_indices()
+        self.active_features = active_features
+        self.windows = 'tw' in active_features
+        self.num_skills = self.Q_mat.shape[1]
+        self.num_windows = NUM_WINDOWS if self.windows else 1
+        self.keys = [key for key in ['a', 'w'] if key in active_features]
+        self.counters = [counter for counter in COUNTERS if counter in active_features]
+
+        # Column offsets of each block, following df_to_sparse
+        self.offsets = {}
+        num_features = 0
+        if 's' in active_features:
+            self.offsets['s'] = num_features
+            num_features += self.num_skills
+        for key in self.keys:
+            self.offsets[key, 'sc'] = num_features
+            self.offsets[key, 'ic'] = num_features + self.num_skills * self.num_windows
+            self.offsets[key, 'tc'] = num_features + (self.num_skills + 1) * self.num_windows
+            num_features += (self.num_skills + 2) * self.num_windows
+        self.columns = {}
+        for key, ids in [('u', user_ids), ('i', item_ids)]:
+            if key in active_features:
+                ids = np.unique(ids)
+                self.columns[key] = dict(zip(ids.tolist(), range(num_features, num_features + len(ids))))
+                num_features += len(ids)
+        self.num_features = num_features
+
+        # Running counts of each user, see get_state, and columns of each item, see get_item_columns
+        self.states = {}
+        self.item_columns = {}
+
+    def get_state(self, user_id):
+        """Running counts of a user.
+
+        Output:
+            counts (array of int): (len(keys), num_skills + 2) past attempts and wins on each
+                skill, then in total, the last column receives the counts of the encoded item
+            item_counts (dict): array of past attempts and wins on each item
+            queues (list of dict): for each of attempts and wins, TimeWindowQueue of each group,
+                indexed by skill id, num_skills for the total and num_skills + 1 + item id
+        """
+        if user_id not in self.states:
+            self.states[user_id] = (np.zeros((len(self.keys), self.num_skills + 2), dtype=np.int64), {},
+                                    [{} for _ in self.keys])
+        return self.states[user_id]
+
+    def get_item_columns(self, item_id):
+        """Columns of an item, computed once.
+
+        Output:
+            skill_ids (array of int): skills of the item
+            skill_vals (array of float): q-matrix values of these skills
+            count_idxs (array of int): columns of get_state counts of the groups counted for the
+                item, i.e. its skills, the item and the total, in feature column order
+            groups (list of int): queue indices of these groups, see get_state
+            count_cols (array of int): feature columns of the counts of each key, group and window
+        """
+        if item_id not in self.item_columns:
+            start, stop = self.Q_mat.indptr[item_id], self.Q_mat.indptr[item_id + 1]
+            skill_ids = self.Q_mat.indices[start:stop]
+            count_idxs, group_cols = [], []
+            if 'sc' in self.counters:
+                count_idxs.append(skill_ids)
+                group_cols.append(skill_ids * self.num_windows)
+            if 'ic' in self.counters:
+                count_idxs.append([self.num_skills + 1])
+                group_cols.append([self.num_skills * self.num_windows])
+            if 'tc' in self.counters:
+                count_idxs.append([self.num_skills])
+                group_cols.append([(self.num_skills + 1) * self.num_windows])
+            count_idxs = np.concatenate(count_idxs).astype(int) if count_idxs else np.zeros(0, dtype=int)
+            groups = [g + item_id if g == self.num_skills + 1 else g for g in count_idxs.tolist()]
+            group_cols = np.concatenate(group_cols).astype(int) if group_cols else np.zeros(0, dtype=int)
+            window_cols = (group_cols[:, None] + np.arange(self.num_windows)).ravel()
+            count_cols = np.concatenate([self.offsets[key, 'sc'] + window_cols for key in self.keys] + [[]])
+            self.item_columns[item_id] = (skill_ids, self.Q_mat.data[start:stop], count_idxs, groups,
+                                          count_cols.astype(int))
+        return self.item_columns[item_id]
+
+    def get_features(self, user_id, item_id, timestamp):
+        """Encode the next interaction of a user, before its outcome is known.
+
+        Output:
+            cols (array of int): sorted nonzero columns of the row of df_to_sparse
+            vals (array of float): values at these columns
+        """
+        skill_ids, skill_vals, count_idxs, groups, count_cols = self.get_item_columns(item_id)
+        cols, vals = [], []
+
+        # Current skills one hot encoding
+        if 's' in self.active_features:
+            cols.append(self.offsets['s'] + skill_ids)
+            vals.append(skill_vals)
+
+        # Past attempts and wins
+        if len(count_cols):
+            counts, item_counts, queues = self.get_state(user_id)
+            counts[:, -1] = item_counts.get(item_id, 0)
+            totals = counts[:, count_idxs]
+            if self.windows:
+                # Totals are already counted, only window counts are read from the queues
+                no_events = [0] * len(WINDOW_LENGTHS)
+                window_counts = [[queues[k][g].get_counters(timestamp)[1:] if g in queues[k] else no_events
+                                  for g in groups] for k in range(len(self.keys))]
+                totals = np.concatenate((totals[..., None], window_counts), axis=-1)
+            cols.append(count_cols)
+            vals.append(phi(totals.ravel()))
+
+        # User and item one hot encodings
+        for key, id_ in [('u', user_id), ('i', item_id)]:
+            if key in self.columns and id_ in self.columns[key]:
+                cols.append([self.columns[key][id_]])
+                vals.append([1])
+
+        cols, vals = np.concatenate(cols).astype(int), np.concatenate(vals).astype(np.float32)
+        nonzero = vals != 0
+        return cols[nonzero], vals[nonzero]
+
+    def get_row(self, user_id, item_id, timestamp):
+        """Same as get_features as a (1, num_features) csr row, equal to the row of df_to_sparse."""
+        cols, vals = self.get_features(user_id, item_id, timestamp)
+        return sparse.csr_matrix((vals, cols, [0, len(cols)]), shape=(1, self.num_features))
+
+    def score(self, user_id, item_id, timestamp, weights, intercept=0.):
+        """Predict the probability of a correct outcome with a logistic regression model.
+
+        Arguments:
+            weights (array of float): (num_features,) weights, e.g. coef_[0] of sklearn
+            intercept (float): e.g. intercept_[0] of sklearn
+        """
+        cols, vals = self.get_features(user_id, item_id, timestamp)
+        return 1 / (1 + np.exp(-(vals @ weights[cols] + intercept)))
+
+    def update(self, user_id, item_id, timestamp, correct):
+        """Record an interaction once its outcome is known."""
+        skill_ids, _, _, groups, _ = self.get_item_columns(item_id)
+        counts, item_counts, queues = self.get_state(user_id)
+        if item_id not in item_counts:
+            item_counts[item_id] = np.zeros(len(self.keys), dtype=np.int64)
+
+        for k, key in enumerate(self.keys):
+            if key == 'w' and not correct:
+                continue
+            counts[k, skill_ids] += 1
+            counts[k, self.num_skills] += 1
+            item_counts[item_id][k] += 1
+            if self.windows:
+                for g in groups:
+                    if g not in queues[k]:
+                        queues[k][g] = TimeWindowQueue(WINDOW_LENGTHS)
+                    queues[k][g].push(timestamp)
+
+    def fit(self, df):
+        """Replay past interactions of a dataframe output by prepare_data.py, sorted by time."""
+        for user_id, item_id, timestamp, correct in df[["user_id", "item_id", "timestamp", "correct"]].values.tolist():
+            self.update(user_id, item_id, timestamp, correct)
+        return self
 
 
 if __name__ == "__main__":
@@ -207,16 +479,21 @@ if __name__ == "__main__":
                         help='If True, historical counts include attempts.')
     parser.add_argument('-tw', action='store_true',
                         help='If True, historical counts are encoded as time windows.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes encoding disjoint shards of users.')
+    parser.add_argument('--no_cache', action='store_true',
+                        help='If True, do not read or write cached feature blocks.')
     args = parser.parse_args()
 
     data_path = os.path.join('data', args.dataset)
-    df = pd.read_csv(os.path.join(data_path, 'preprocessed_data.csv'), sep="\t")
+    df = load_preprocessed(data_path)
     df = df[["user_id", "item_id", "timestamp", "correct", "skill_id"]]
-    Q_mat = sparse.load_npz(os.path.join(data_path, 'q_mat.npz')).toarray()
+    Q_mat = sparse.load_npz(os.path.join(data_path, 'q_mat.npz'))
 
     all_features = ['u', 'i', 's', 'ic', 'sc', 'tc', 'w', 'a', 'tw']
     active_features = [features for features in all_features if vars(args)[features]]
     features_suffix = ''.join(active_features)
 
-    X = df_to_sparse(df, Q_mat, active_features)
-    sparse.save_npz(os.path.join(data_path, f"X-{features_suffix}"), X)
\ No newline at end of file
+    cache_dir = None if args.no_cache else os.path.join(data_path, "feature_blocks")
+    X, meta, column_blocks = df_to_sparse(df, Q_mat, active_features, args.workers, cache_dir)
+    save_encoded(X, meta, os.path.join(data_path, f"X-{features_suffix}.npz"), column_blocks)
\ No newline at end of file
@@ -6,6 +6,7 @@ from random import shuffle
 from torch.nn.utils.rnn import pad_sequence
 import numpy as np
 from typing import List
+from utils.data import get_user_offsets
 
 
 class DktRunner():
@@ -30,18 +31,22 @@ class DktRunner():
         df: standard data format for the algorithm (reference data folder)
         This function was taken and adapted from "train_dkt2.py" 
         """
-        item_ids = [torch.tensor(u_df["item_id"].values, dtype=torch.long)
-                for _, u_df in df.groupby("user_id")]
-        skill_ids = [torch.tensor(u_df["skill_id"].values, dtype=torch.long)
-                    for _, u_df in df.groupby("user_id")]
-        labels = [torch.tensor(u_df["correct"].values, dtype=torch.long)
-                for _, u_df in df.groupby("user_id")]
-
-        item_inputs = [torch.cat((torch.zeros(1, dtype=torch.long), i))[:-1] for i in item_ids]
-        skill_inputs = [torch.cat((torch.zeros(1, dtype=torch.long), s))[:-1] for s in skill_ids]
-        label_inputs = [torch.cat((torch.zeros(1, dtype=torch.long), l))[:-1] for l in labels]
-
-        data = list(zip(item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, labels))
+        # Sequences are sliced from flat arrays, a stable sort makes rows of each user contiguous
+        # and keeps their order, like the groupby it replaces
+        df = df.sort_values("user_id", kind="stable")
+        offsets = get_user_offsets(df["user_id"].values)
+        starts, lengths = offsets[:-1], np.diff(offsets).tolist()
+
+        item_ids = torch.tensor(df["item_id"].values.astype(np.int64))
+        skill_ids = torch.tensor(df["skill_id"].values.astype(np.int64))
+        labels = torch.tensor(df["correct"].values.astype(np.int64))
+
+        shifted = [torch.cat((torch.zeros(1, dtype=torch.long), x[:-1])) for x in (item_ids, skill_ids, labels)]
+        for x in shifted:
+            x[starts] = 0
+
+        lists = [torch.split(x, lengths) for x in (*shifted, item_ids, skill_ids, labels)]
+        data = list(zip(*lists))
         if randomize:
             shuffle(data)
 
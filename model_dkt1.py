@@ -1,6 +1,9 @@
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 
 class DKT1(nn.Module):
@@ -28,24 +31,95 @@ class DKT1(nn.Module):
         self.skill_out = skill_out
         self.input_size = (2 * num_items + 1) * item_in + (2 * num_skills + 1) * skill_in
         self.output_size = num_items * item_out + num_skills * skill_out
-        
-        self.lstm = nn.LSTM(self.input_size, hid_size, num_hid_layers, batch_first=True)
+        self.build_inputs(hid_size, num_hid_layers)
         self.dropout = nn.Dropout(p=drop_prob)
         self.out = nn.Linear(hid_size, self.output_size)
 
-    def forward(self, item_inputs, skill_inputs, hidden=None):
+    def build_inputs(self, hid_size, num_hid_layers):
+        """Create input embeddings and LSTM.
+
+        Inputs are one hot, so their product with the LSTM input weights is a lookup of the
+        weight columns. Embeddings hold these columns and the LSTM input weights are fixed
+        to identity, which avoids materializing (batch_size, length, input_size) inputs.
+        """
+        bound = 1 / math.sqrt(hid_size)
+        self.item_embeds = nn.Embedding(2 * self.num_items + 1, 4 * hid_size) if self.item_in else None
+        self.skill_embeds = nn.Embedding(2 * self.num_skills + 1, 4 * hid_size) if self.skill_in else None
+        for embeds in (self.item_embeds, self.skill_embeds):
+            if embeds is not None:
+                nn.init.uniform_(embeds.weight, -bound, bound)
+
+        self.lstm = nn.LSTM(4 * hid_size, hid_size, num_hid_layers, batch_first=True)
+        with torch.no_grad():
+            self.lstm.weight_ih_l0.copy_(torch.eye(4 * hid_size))
+        self.lstm.weight_ih_l0.requires_grad = False
+
+        # State dicts saved with one hot inputs are converted when loaded
+        if hasattr(self, 'register_load_state_dict_pre_hook'):
+            self.register_load_state_dict_pre_hook(DKT1.convert_one_hot_weights)
+        else:
+            self._register_load_state_dict_pre_hook(self.convert_one_hot_weights)
+
+    def __setstate__(self, state):
+        """Convert models pickled with one hot inputs, e.g. by Saver, when they are loaded."""
+        super(DKT1, self).__setstate__(state)
+        if not hasattr(self, 'item_embeds'):
+            state_dict = self.state_dict()
+            device = self.lstm.weight_hh_l0.device
+            self.build_inputs(self.lstm.hidden_size, self.lstm.num_layers)
+            self.to(device)
+            self.load_state_dict(state_dict)
+
+    def convert_one_hot_weights(self, state_dict, prefix, *args):
+        """Load state dicts of models with one hot inputs, whose LSTM input weights hold the
+        item and skill input embeddings as columns.
+        """
+        key = prefix + 'lstm.weight_ih_l0'
+        if (key not in state_dict) or any(k.startswith(prefix + name) for k in state_dict
+                                           for name in ('item_embeds.', 'skill_embeds.')):
+            return
+        weight_ih = state_dict[key]
+        columns = weight_ih.t()
+        if self.item_in:
+            state_dict[prefix + 'item_embeds.weight'] = columns[:2 * self.num_items + 1]
+            columns = columns[2 * self.num_items + 1:]
+        if self.skill_in:
+            state_dict[prefix + 'skill_embeds.weight'] = columns
+        state_dict[key] = torch.eye(weight_ih.size(0), dtype=weight_ih.dtype, device=weight_ih.device)
+
+    def forward(self, item_inputs, skill_inputs, hidden=None, lengths=None, output_ids=None):
+        """
+        Arguments:
+            item_inputs (torch Tensor): (batch_size, length) item inputs, None if unused
+            skill_inputs (torch Tensor): (batch_size, length) skill inputs, None if unused
+            hidden (tuple of torch Tensor): initial LSTM state
+            lengths (torch Tensor): if not None, (batch_size,) cpu tensor of sequence lengths,
+                the LSTM is run on packed sequences and skips padded timesteps
+            output_ids (torch Tensor): if not None, (batch_size, length) item or skill queried
+                at each timestep, only their logits are computed from gathered output weights,
+                otherwise logits of every output are returned
+        """
         # Pad inputs with 0, this explains the +1
         if (item_inputs is not None) and (skill_inputs is not None):
-            item_onehots = F.one_hot(item_inputs, 2 * self.num_items + 1).float()
-            skill_onehots = F.one_hot(skill_inputs, 2 * self.num_skills + 1).float()
-            input = torch.cat((item_onehots, skill_onehots), -1)
+            input = self.item_embeds(item_inputs) + self.skill_embeds(skill_inputs)
         elif (item_inputs is not None):
-            input = F.one_hot(item_inputs, 2 * self.num_items + 1).float()
+            input = self.item_embeds(item_inputs)
         elif (skill_inputs is not None):
-            input = F.one_hot(skill_inputs, 2 * self.num_skills + 1).float()
+            input = self.skill_embeds(skill_inputs)
+
+        if lengths is None:
+            output, hidden = self.lstm(input, hx=hidden)
+        else:
+            packed = pack_padded_sequence(input, lengths, batch_first=True, enforce_sorted=False)
+            output, hidden = self.lstm(packed, hx=hidden)
+            output, _ = pad_packed_sequence(output, batch_first=True, total_length=input.size(1))
+        output = self.dropout(output)
 
-        output, hidden = self.lstm(input, hx=hidden)
-        return self.out(self.dropout(output)), hidden
+        if output_ids is None:
+            return self.out(output), hidden
+        weight = F.embedding(output_ids, self.out.weight)
+        bias = F.embedding(output_ids, self.out.bias.unsqueeze(-1)).squeeze(-1)
+        return (output * weight).sum(-1) + bias, hidden
 
     def repackage_hidden(self, hidden):
         # Return detached hidden for TBPTT
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 
 class DKT2(nn.Module):
@@ -28,11 +29,22 @@ class DKT2(nn.Module):
         self.lin1 = nn.Linear(hid_size + embed_size, hid_size)
         self.lin2 = nn.Linear(hid_size, 1)
 
-    def forward(self, item_inputs, skill_inputs, label_inputs, item_ids, skill_ids):
+    def forward(self, item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, lengths=None):
+        """
+        Arguments:
+            item_inputs, skill_inputs, label_inputs, item_ids, skill_ids (torch Tensor): (batch_size, length)
+            lengths (torch Tensor): if not None, (batch_size,) cpu tensor of sequence lengths,
+                the LSTM is run on packed sequences and skips padded timesteps
+        """
         inputs = self.get_inputs(item_inputs, skill_inputs, label_inputs)
         query = self.get_query(item_ids, skill_ids)
 
-        x, _ = self.lstm(inputs)
+        if lengths is None:
+            x, _ = self.lstm(inputs)
+        else:
+            packed = pack_padded_sequence(inputs, lengths, batch_first=True, enforce_sorted=False)
+            x, _ = self.lstm(packed)
+            x, _ = pad_packed_sequence(x, batch_first=True, total_length=inputs.size(1))
         x = self.lin1(torch.cat([self.dropout(x), query], dim=-1))
         x = self.lin2(torch.relu(self.dropout(x))).squeeze(-1)
         return x
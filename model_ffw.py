@@ -1,13 +1,38 @@
+import math
+
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 
 class FeedForward(nn.Module):
     def __init__(self, input_size, hid_size, drop_prob):
+        """Feedforward network on sparse feature rows.
+
+        The input layer sums the embeddings of the nonzero features weighted by their values,
+        equal to a linear layer on the dense rows at a cost linear in the number of nonzeros.
+
+        Arguments:
+            input_size (int): number of features
+            hid_size (int): hidden layer size
+            drop_prob (float): dropout probability
+        """
         super(FeedForward, self).__init__()
-        self.lin1 = nn.Linear(input_size, hid_size)
+        self.lin1 = nn.EmbeddingBag(input_size, hid_size, mode='sum')
+        self.bias1 = nn.Parameter(torch.empty(hid_size))
         self.lin2 = nn.Linear(hid_size, 1)
         self.dropout = nn.Dropout(p=drop_prob)
 
-    def forward(self, inputs):
-        return self.lin2(F.relu(self.dropout(self.lin1(inputs))))
+        # Same initialization as a linear layer
+        bound = 1 / math.sqrt(input_size)
+        nn.init.uniform_(self.lin1.weight, -bound, bound)
+        nn.init.uniform_(self.bias1, -bound, bound)
+
+    def forward(self, indices, offsets, values):
+        """
+        Arguments:
+            indices, offsets, values (torch Tensor): csr batch, i.e. columns and values of the
+                nonzeros and start of each row among them
+        """
+        hidden = self.lin1(indices, offsets, per_sample_weights=values) + self.bias1
+        return self.lin2(F.relu(self.dropout(hidden)))
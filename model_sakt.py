@@ -140,7 +140,13 @@ class SAKT(nn.Module):
         query = torch.cat([item_ids, skill_ids], dim=-1)
         return query
 
-    def forward(self, item_inputs, skill_inputs, label_inputs, item_ids, skill_ids):
+    def forward(self, item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, segments=None):
+        """
+        Arguments:
+            item_inputs, skill_inputs, label_inputs, item_ids, skill_ids (torch Tensor): (batch_size, length)
+            segments (torch Tensor): if not None, (batch_size, length) sequence of each interaction
+                when rows hold several sequences, attention is restricted to the same sequence
+        """
         inputs = self.get_inputs(item_inputs, skill_inputs, label_inputs)
         inputs = F.relu(self.lin_in(inputs))
 
@@ -149,6 +155,9 @@ class SAKT(nn.Module):
         mask = future_mask(inputs.size(-2))
         if inputs.is_cuda:
             mask = mask.cuda()
+        if segments is not None:
+            # Block-diagonal mask over the sequences packed in each row
+            mask = mask | (segments.unsqueeze(-1) != segments.unsqueeze(-2))
 
         outputs = self.dropout(self.attn_layers[0](query, inputs, inputs, self.encode_pos,
                                                    self.pos_key_embeds, self.pos_value_embeds, mask))
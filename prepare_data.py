@@ -3,25 +3,136 @@ import pandas as pd
 from scipy import sparse
 import argparse
 import os
+import pickle
+import tempfile
 
+from utils.data import (COLUMN_DTYPES, get_data_file, create_columns, load_preprocessed, save_preprocessed,
+                        save_user_offsets)
+
+
+# Column giving temporal order within each user, ties keep the raw file order
+TIME_COLS = {"assistments09": "order_id",
+             "assistments12": "timestamp",
+             "assistments15": "log_id",
+             "assistments17": "timestamp",
+             "bridge_algebra06": "timestamp",
+             "algebra05": "timestamp"}
+
+
+def build_q_mat(item_ids, skill_ids, num_items, num_skills):
+    """Build sparse q-matrix directly from item-skill pairs.
 
-def prepare_assistments(data_name, min_interactions_per_user, remove_nan_skills, train_split=0.8):
-    """Preprocess ASSISTments dataset.
-    
     Arguments:
-        data_name: "assistments09", "assistments12", "assistments15" or "assistments17"
-        min_interactions_per_user (int): minimum number of interactions per student
-        remove_nan_skills (bool): if True, remove interactions with no skill tag
-        train_split (float): proportion of data to use for training
+        item_ids (array of int): item of each pair
+        skill_ids (array of int): skill of each pair
+        num_items (int): number of rows
+        num_skills (int): number of columns
 
-    Outputs:
-        df (pandas DataFrame): preprocessed ASSISTments dataset with user_id, item_id,
-            timestamp, correct and unique skill features
-        Q_mat (item-skill relationships sparse array): corresponding q-matrix
+    Output:
+        Q_mat (sparse csr matrix): Q_mat[i, j] = 1 if item i requires skill j
     """
-    data_path = os.path.join("data", data_name)
-    df = pd.read_csv(os.path.join(data_path, "data.csv"), encoding="ISO-8859-1")
+    Q_mat = sparse.coo_matrix((np.ones(len(item_ids)), (item_ids, skill_ids)),
+                              shape=(num_items, num_skills)).tocsr()
+    Q_mat.data[:] = 1  # Duplicate pairs are summed by tocsr
+    return Q_mat
+
+
+def pack_q_rows(Q_mat):
+    """Bit-pack q-matrix rows, sorting packed rows is the same as sorting dense rows."""
+    rows, cols = Q_mat.nonzero()
+    packed = np.zeros((Q_mat.shape[0], (Q_mat.shape[1] + 7) // 8), dtype=np.uint8)
+    np.bitwise_or.at(packed, (rows, cols // 8), (128 >> (cols % 8)).astype(np.uint8))
+    return packed
+
+
+def get_unique_skill_ids(Q_mat):
+    """Give each item the index of its combination of skills.
+
+    Same numbering as np.unique(Q_mat.toarray(), axis=0), without densifying the q-matrix.
+
+    Arguments:
+        Q_mat (sparse csr matrix): q-matrix
+
+    Output:
+        unique_skill_ids (array of int): unique skill id of each item
+    """
+    return np.unique(pack_q_rows(Q_mat), axis=0, return_inverse=True)[1].reshape(-1)
+
+
+def extend_skill_ids(item_skill_ids, old_Q_mat, Q_mat):
+    """Give unique skill ids to new items and to items whose combination of skills changed.
+
+    Combinations already in old_Q_mat keep their id, new combinations get ids after the last one.
+
+    Arguments:
+        item_skill_ids (array of int): unique skill id of each item of old_Q_mat
+        old_Q_mat (sparse csr matrix): previous q-matrix, with as many columns as Q_mat
+        Q_mat (sparse csr matrix): q-matrix extended with new items and skills
+
+    Output:
+        item_skill_ids (array of int): unique skill id of each item of Q_mat
+    """
+    combinations, inverse = np.unique(np.vstack((pack_q_rows(old_Q_mat), pack_q_rows(Q_mat))),
+                                      axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    old_inverse, new_inverse = inverse[:old_Q_mat.shape[0]], inverse[old_Q_mat.shape[0]:]
+
+    combination_ids = np.full(len(combinations), -1, dtype=np.int64)
+    combination_ids[old_inverse] = item_skill_ids
+    unseen = np.unique(new_inverse[combination_ids[new_inverse] < 0])
+    combination_ids[unseen] = item_skill_ids.max() + 1 + np.arange(len(unseen))
+    return combination_ids[new_inverse]
+
+
+def extend_vocab(vocab, values):
+    """Map raw values to indices in vocab, appending unknown values after existing ones.
+
+    Arguments:
+        vocab (array): raw value of each index
+        values (array): raw values to map
+
+    Output:
+        vocab (array): extended vocabulary
+        ids (array of int): index of each value
+    """
+    known = pd.Index(vocab).get_indexer(values) >= 0
+    new_values = np.unique(values[~known])
+    if len(new_values) > 0:
+        vocab = np.concatenate((vocab, new_values))
+    return vocab, pd.Index(vocab).get_indexer(values)
 
+
+def save_vocab(data_path, vocab):
+    """Persist raw id vocabularies so that later runs can append interactions with stable ids.
+
+    Arguments:
+        data_path (str): dataset folder
+        vocab (dict): "users", "items" and "skills" raw values in index order, "item_skill_ids"
+            unique skill id of each item and "min_timestamp" raw origin of timestamps
+    """
+    with open(os.path.join(data_path, "vocab.pkl"), "wb") as f:
+        pickle.dump(vocab, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_vocab(data_path):
+    with open(os.path.join(data_path, "vocab.pkl"), "rb") as f:
+        return pickle.load(f)
+
+
+def filter_short_users(df, min_interactions_per_user):
+    """Remove users with fewer than min_interactions_per_user interactions."""
+    lengths = df.groupby("user_id")["user_id"].transform("size")
+    return df[lengths.values >= min_interactions_per_user]
+
+
+def sort_by_user(df, time_col=None):
+    """Sort data by users, preserving temporal (then original) order for each user."""
+    keys = (df["user_id"].values,) if time_col is None else (df[time_col].values, df["user_id"].values)
+    return df.iloc[np.lexsort(keys)]
+
+
+def format_assistments(df, data_name):
+    """Rename ASSISTments columns and add raw timestamps (not yet shifted by shift_timestamps)."""
     # Only 2012 and 2017 versions have timestamps
     if data_name == "assistments09":
         df = df.rename(columns={"problem_id": "item_id"})
@@ -29,8 +140,6 @@ def prepare_assistments(data_name, min_interactions_per_user, remove_nan_skills,
     elif data_name == "assistments12":
         df = df.rename(columns={"problem_id": "item_id"})
         df["timestamp"] = pd.to_datetime(df["start_time"])
-        df["timestamp"] = df["timestamp"] - df["timestamp"].min()
-        df["timestamp"] = df["timestamp"].apply(lambda x: x.total_seconds()).astype(np.int64)
     elif data_name == "assistments15":
         df = df.rename(columns={"sequence_id": "item_id"})
         df["skill_id"] = df["item_id"]
@@ -40,29 +149,75 @@ def prepare_assistments(data_name, min_interactions_per_user, remove_nan_skills,
                                 "studentId": "user_id",
                                 "problemId": "item_id",
                                 "skill": "skill_id"})
-        df["timestamp"] = df["timestamp"] - df["timestamp"].min()
+    return df
+
+
+def format_kddcup10(df):
+    """Rename KDD Cup 2010 columns, add items and raw timestamps (not yet shifted by shift_timestamps)."""
+    df = df.rename(columns={'Anon Student Id': 'user_id',
+                            'Correct First Attempt': 'correct'})
 
+    # Create item from problem and step
+    df["item_id"] = df["Problem Name"] + ":" + df["Step Name"]
+
+    # Add timestamp
+    df["timestamp"] = pd.to_datetime(df["First Transaction Time"])
+    return df
+
+
+def shift_timestamps(timestamps, min_timestamp):
+    """Express raw timestamps as integer seconds elapsed since min_timestamp."""
+    timestamps = timestamps - min_timestamp
+    if pd.api.types.is_timedelta64_dtype(timestamps):
+        timestamps = timestamps.dt.total_seconds().astype(np.int64)
+    return timestamps
+
+
+def clean_interactions(df, skill_col, remove_nan_skills, nan_skill):
+    """Remove continuous outcomes and handle interactions with no skill tag."""
     # Remove continuous outcomes
     df = df[df["correct"].isin([0, 1])]
     df["correct"] = df["correct"].astype(np.int32)
 
     # Filter nan skills
     if remove_nan_skills:
-        df = df[~df["skill_id"].isnull()]
+        df = df[~df[skill_col].isnull()]
     else:
-        df.ix[df["skill_id"].isnull(), "skill_id"] = -1
+        df.loc[df[skill_col].isnull(), skill_col] = nan_skill
+    return df
+
+
+def prepare_assistments(data_name, min_interactions_per_user, remove_nan_skills, train_split=0.8):
+    """Preprocess ASSISTments dataset.
+    
+    Arguments:
+        data_name: "assistments09", "assistments12", "assistments15" or "assistments17"
+        min_interactions_per_user (int): minimum number of interactions per student
+        remove_nan_skills (bool): if True, remove interactions with no skill tag
+        train_split (float): proportion of data to use for training
+
+    Outputs:
+        df (pandas DataFrame): preprocessed ASSISTments dataset with user_id, item_id,
+            timestamp, correct and unique skill features
+        Q_mat (item-skill relationships sparse array): corresponding q-matrix
+    """
+    data_path = os.path.join("data", data_name)
+    df = pd.read_csv(os.path.join(data_path, "data.csv"), encoding="ISO-8859-1")
+    df = format_assistments(df, data_name)
+    min_timestamp = df["timestamp"].min()
+    df["timestamp"] = shift_timestamps(df["timestamp"], min_timestamp)
+    df = clean_interactions(df, "skill_id", remove_nan_skills, -1)
 
     # Filter too short sequences
-    df = df.groupby("user_id").filter(lambda x: len(x) >= min_interactions_per_user)
+    df = filter_short_users(df, min_interactions_per_user)
 
-    df["user_id"] = np.unique(df["user_id"], return_inverse=True)[1]
-    df["item_id"] = np.unique(df["item_id"], return_inverse=True)[1]
-    df["skill_id"] = np.unique(df["skill_id"], return_inverse=True)[1]
+    user_vocab, df["user_id"] = np.unique(df["user_id"], return_inverse=True)
+    item_vocab, df["item_id"] = np.unique(df["item_id"], return_inverse=True)
+    skill_vocab, df["skill_id"] = np.unique(df["skill_id"], return_inverse=True)
 
     # Build Q-matrix
-    Q_mat = np.zeros((len(df["item_id"].unique()), len(df["skill_id"].unique())))
-    for item_id, skill_id in df[["item_id", "skill_id"]].values:
-        Q_mat[item_id, skill_id] = 1
+    Q_mat = build_q_mat(df["item_id"].values, df["skill_id"].values,
+                        df["item_id"].max() + 1, df["skill_id"].max() + 1)
 
     # Remove row duplicates due to multiple skills for one item
     if data_name == "assistments09":
@@ -71,19 +226,11 @@ def prepare_assistments(data_name, min_interactions_per_user, remove_nan_skills,
         df = df.drop_duplicates(["user_id", "timestamp"])
 
     # Get unique skill id from combination of all skill ids
-    unique_skill_ids = np.unique(Q_mat, axis=0, return_inverse=True)[1]
+    unique_skill_ids = get_unique_skill_ids(Q_mat)
     df["skill_id"] = unique_skill_ids[df["item_id"]]
 
-    # Sort data temporally
-    if data_name in ["assistments12", "assistments17"]:
-        df.sort_values(by="timestamp", inplace=True)
-    elif data_name == "assistments09":
-        df.sort_values(by="order_id", inplace=True)
-    elif data_name == "assistments15":
-        df.sort_values(by="log_id", inplace=True)
-
     # Sort data by users, preserving temporal order for each user
-    df = pd.concat([u_df for _, u_df in df.groupby("user_id")])
+    df = sort_by_user(df, TIME_COLS[data_name])
 
     df = df[["user_id", "item_id", "timestamp", "correct", "skill_id"]]
     df.reset_index(inplace=True, drop=True)
@@ -101,13 +248,15 @@ def prepare_assistments(data_name, min_interactions_per_user, remove_nan_skills,
     test_df = df[df["user_id"].isin(users[split:])]
 
     # Save data
-    sparse.save_npz(os.path.join(data_path, "q_mat.npz"), sparse.csr_matrix(Q_mat))
-    train_df.to_csv(os.path.join(data_path, "preprocessed_data_train.csv"), sep="\t", index=False)
-    test_df.to_csv(os.path.join(data_path, "preprocessed_data_test.csv"), sep="\t", index=False)
-    df.to_csv(os.path.join(data_path, "preprocessed_data.csv"), sep="\t", index=False)
+    sparse.save_npz(os.path.join(data_path, "q_mat.npz"), Q_mat)
+    save_preprocessed(train_df, data_path, "train")
+    save_preprocessed(test_df, data_path, "test")
+    save_preprocessed(df, data_path)
     np.savetxt(os.path.join(data_path, "bkt_dataset.txt"), bkt_dataset, fmt='%i')
     np.savetxt(os.path.join(data_path, "bkt_expert_labels.txt"), bkt_skills, fmt='%i')
     np.savetxt(os.path.join(data_path, "bkt_splits.txt"), bkt_split, fmt='%i')
+    save_vocab(data_path, {"users": user_vocab, "items": item_vocab, "skills": skill_vocab,
+                           "item_skill_ids": unique_skill_ids, "min_timestamp": min_timestamp})
 
 
 def prepare_kddcup10(data_name, min_interactions_per_user, kc_col_name, remove_nan_skills, train_split=0.8):
@@ -127,59 +276,32 @@ def prepare_kddcup10(data_name, min_interactions_per_user, kc_col_name, remove_n
     """
     data_path = os.path.join("data", data_name)
     df = pd.read_csv(os.path.join(data_path, "data.txt"), delimiter='\t')
-    df = df.rename(columns={'Anon Student Id': 'user_id',
-                            'Correct First Attempt': 'correct'})
-
-    # Create item from problem and step
-    df["item_id"] = df["Problem Name"] + ":" + df["Step Name"]
-
-    # Add timestamp
-    df["timestamp"] = pd.to_datetime(df["First Transaction Time"])
-    df["timestamp"] = df["timestamp"] - df["timestamp"].min()
-    df["timestamp"] = df["timestamp"].apply(lambda x: x.total_seconds()).astype(np.int64)
-
-    # Remove continuous outcomes
-    df = df[df["correct"].isin([0, 1])]
-    df['correct'] = df['correct'].astype(np.int32)
-
-    # Filter nan skills
-    if remove_nan_skills:
-        df = df[~df[kc_col_name].isnull()]
-    else:
-        df.ix[df[kc_col_name].isnull(), kc_col_name] = 'NaN'
+    df = format_kddcup10(df)
+    min_timestamp = df["timestamp"].min()
+    df["timestamp"] = shift_timestamps(df["timestamp"], min_timestamp)
+    df = clean_interactions(df, kc_col_name, remove_nan_skills, 'NaN')
 
     # Drop duplicates
     df.drop_duplicates(subset=["user_id", "item_id", "timestamp"], inplace=True)
 
     # Filter too short sequences
-    df = df.groupby("user_id").filter(lambda x: len(x) >= min_interactions_per_user)
-
-    # Extract KCs
-    kc_list = []
-    for kc_str in df[kc_col_name].unique():
-        for kc in kc_str.split('~~'):
-            kc_list.append(kc)
-    kc_set = set(kc_list)
-    kc2idx = {kc: i for i, kc in enumerate(kc_set)}
+    df = filter_short_users(df, min_interactions_per_user)
 
-    df["user_id"] = np.unique(df["user_id"], return_inverse=True)[1]
-    df["item_id"] = np.unique(df["item_id"], return_inverse=True)[1]
+    user_vocab, df["user_id"] = np.unique(df["user_id"], return_inverse=True)
+    item_vocab, df["item_id"] = np.unique(df["item_id"], return_inverse=True)
 
-    # Build Q-matrix
-    Q_mat = np.zeros((len(df["item_id"].unique()), len(kc_set)))
-    for item_id, kc_str in df[["item_id", kc_col_name]].values:
-        for kc in kc_str.split('~~'):
-            Q_mat[item_id, kc2idx[kc]] = 1
+    # Extract KCs of every distinct item and build Q-matrix
+    item_kcs = df[["item_id", kc_col_name]].drop_duplicates()
+    item_kcs = item_kcs.assign(kc=item_kcs[kc_col_name].str.split('~~')).explode("kc")
+    kcs, kc_ids = np.unique(item_kcs["kc"], return_inverse=True)
+    Q_mat = build_q_mat(item_kcs["item_id"].values, kc_ids, df["item_id"].max() + 1, len(kcs))
 
     # Get unique skill id from combination of all skill ids
-    unique_skill_ids = np.unique(Q_mat, axis=0, return_inverse=True)[1]
+    unique_skill_ids = get_unique_skill_ids(Q_mat)
     df["skill_id"] = unique_skill_ids[df["item_id"]]
 
-    # Sort data temporally
-    df.sort_values(by="timestamp", inplace=True)
-
     # Sort data by users, preserving temporal order for each user
-    df = pd.concat([u_df for _, u_df in df.groupby("user_id")])
+    df = sort_by_user(df, TIME_COLS[data_name])
 
     df = df[["user_id", "item_id", "timestamp", "correct", "skill_id"]]
     df.reset_index(inplace=True, drop=True)
@@ -197,13 +319,302 @@ def prepare_kddcup10(data_name, min_interactions_per_user, kc_col_name, remove_n
     test_df = df[df["user_id"].isin(users[split:])]
 
     # Save data
-    sparse.save_npz(os.path.join(data_path, "q_mat.npz"), sparse.csr_matrix(Q_mat))
-    train_df.to_csv(os.path.join(data_path, "preprocessed_data_train.csv"), sep="\t", index=False)
-    test_df.to_csv(os.path.join(data_path, "preprocessed_data_test.csv"), sep="\t", index=False)
-    df.to_csv(os.path.join(data_path, "preprocessed_data.csv"), sep="\t", index=False)
+    sparse.save_npz(os.path.join(data_path, "q_mat.npz"), Q_mat)
+    save_preprocessed(train_df, data_path, "train")
+    save_preprocessed(test_df, data_path, "test")
+    save_preprocessed(df, data_path)
     np.savetxt(os.path.join(data_path, "bkt_dataset.txt"), bkt_dataset, fmt='%i')
     np.savetxt(os.path.join(data_path, "bkt_expert_labels.txt"), bkt_skills, fmt='%i')
     np.savetxt(os.path.join(data_path, "bkt_splits.txt"), bkt_split, fmt='%i')
+    save_vocab(data_path, {"users": user_vocab, "items": item_vocab, "skills": kcs,
+                           "item_skill_ids": unique_skill_ids, "min_timestamp": min_timestamp})
+
+
+def load_bucket(path):
+    """Concatenate the dataframes successively pickled in a bucket file."""
+    dfs = []
+    with open(path, "rb") as f:
+        while True:
+            try:
+                dfs.append(pickle.load(f))
+            except EOFError:
+                break
+    return pd.concat(dfs)
+
+
+def save_bucket(df, path, mode="wb"):
+    with open(path, mode) as f:
+        pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def prepare_out_of_core(data_name, min_interactions_per_user, remove_nan_skills, kc_col_name=None,
+                        chunksize=1000000, num_buckets=32, train_split=0.8):
+    """Preprocess ASSISTments or KDD Cup 2010 dataset without loading the raw file in memory.
+
+    The raw file is read in chunks whose rows are partitioned by user into temporary bucket
+    files. Buckets are then filtered, remapped and sorted one at a time and scattered into
+    memory-mapped output columns, so peak memory is bounded by the chunk and bucket sizes.
+    Outputs are the same as prepare_assistments or prepare_kddcup10 for the same random state.
+
+    Arguments:
+        data_name (str): ASSISTments or KDD Cup 2010 dataset codename
+        min_interactions_per_user (int): minimum number of interactions per student
+        remove_nan_skills (bool): if True, remove interactions with no skill tag
+        kc_col_name (str): Skills id column for KDD Cup 2010 datasets, None for ASSISTments
+        chunksize (int): number of raw rows read at once
+        num_buckets (int): number of temporary user partitions
+        train_split (float): proportion of data to use for training
+    """
+    data_path = os.path.join("data", data_name)
+    kddcup = kc_col_name is not None
+    skill_col = kc_col_name if kddcup else "skill_id"
+    time_col = TIME_COLS[data_name]
+    columns = list(COLUMN_DTYPES)
+
+    # Temporary buckets are removed even if preprocessing fails
+    with tempfile.TemporaryDirectory(dir=data_path) as tmp_path:
+        buckets = [os.path.join(tmp_path, f"bucket_{b}.pkl") for b in range(num_buckets)]
+
+        if kddcup:
+            reader = pd.read_csv(os.path.join(data_path, "data.txt"), delimiter='\t', chunksize=chunksize)
+        else:
+            reader = pd.read_csv(os.path.join(data_path, "data.csv"), encoding="ISO-8859-1", chunksize=chunksize)
+
+        # Partition raw rows by user, rows of a bucket keep their order in the raw file
+        min_timestamp = None
+        for chunk in reader:
+            chunk = format_kddcup10(chunk) if kddcup else format_assistments(chunk, data_name)
+            chunk_min = chunk["timestamp"].min()
+            if not pd.isnull(chunk_min):
+                min_timestamp = chunk_min if min_timestamp is None else min(min_timestamp, chunk_min)
+            chunk = clean_interactions(chunk, skill_col, remove_nan_skills, 'NaN' if kddcup else -1)
+            chunk = chunk[list(dict.fromkeys(["user_id", "item_id", "timestamp", "correct", skill_col, time_col]))]
+
+            # Hash numeric ids as floats so that a user parsed as int or float lands in the same bucket
+            user_ids = chunk["user_id"].values
+            if user_ids.dtype.kind in "iuf":
+                user_ids = user_ids.astype(np.float64)
+            bucket_ids = pd.util.hash_array(user_ids) % num_buckets
+            for b, bucket_df in chunk.groupby(bucket_ids):
+                save_bucket(bucket_df, buckets[b], "ab")
+        buckets = [path for path in buckets if os.path.exists(path)]
+
+        # Filter every bucket and collect id vocabularies and item-skill pairs
+        user_ids, item_ids, item_skills = [], [], []
+        for path in buckets:
+            df = load_bucket(path)
+            df["timestamp"] = shift_timestamps(df["timestamp"], min_timestamp)
+            if kddcup:
+                df = df.drop_duplicates(subset=["user_id", "item_id", "timestamp"])
+            df = filter_short_users(df, min_interactions_per_user)
+            user_ids.append(df["user_id"].unique())
+            item_ids.append(df["item_id"].unique())
+            item_skills.append(df[["item_id", skill_col]].drop_duplicates())
+            save_bucket(df, path)
+
+        user_vocab = np.unique(np.concatenate(user_ids))
+        item_vocab = np.unique(np.concatenate(item_ids))
+        item_skills = pd.concat(item_skills).drop_duplicates()
+        if kddcup:
+            item_skills = item_skills.assign(kc=item_skills[kc_col_name].str.split('~~')).explode("kc")
+            skill_col = "kc"
+        skills, skill_ids = np.unique(item_skills[skill_col], return_inverse=True)
+
+        # Build Q-matrix
+        Q_mat = build_q_mat(np.searchsorted(item_vocab, item_skills["item_id"].values), skill_ids,
+                            len(item_vocab), len(skills))
+        unique_skill_ids = get_unique_skill_ids(Q_mat)
+
+        # Remap ids and sort each bucket
+        lengths = np.zeros(len(user_vocab), dtype=np.int64)
+        for path in buckets:
+            df = load_bucket(path)
+            df["user_id"] = np.searchsorted(user_vocab, df["user_id"].values)
+            df["item_id"] = np.searchsorted(item_vocab, df["item_id"].values)
+
+            # Remove row duplicates due to multiple skills for one item
+            if data_name == "assistments09":
+                df = df.drop_duplicates("order_id")
+            elif data_name == "assistments17":
+                df = df.drop_duplicates(["user_id", "timestamp"])
+
+            df["skill_id"] = unique_skill_ids[df["item_id"]]
+            df = sort_by_user(df, time_col)[columns]
+            lengths += np.bincount(df["user_id"], minlength=len(user_vocab))
+            save_bucket(df, path)
+
+        # Merge buckets on disk, each user block goes to its position in the user-sorted output
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        num_rows = int(offsets[-1])
+        full = create_columns(get_data_file(data_path), num_rows, columns)
+        for path in buckets:
+            df = load_bucket(path)
+            bucket_user_ids = df["user_id"].values
+            starts = np.flatnonzero(np.r_[True, bucket_user_ids[1:] != bucket_user_ids[:-1]])
+            ranks = np.arange(len(df)) - np.repeat(starts, np.diff(np.r_[starts, len(df)]))
+            positions = offsets[bucket_user_ids] + ranks
+            for col in columns:
+                full[col][positions] = df[col].values
+
+    # Text files for BKT implementation (https://github.com/robert-lindsey/WCRP/)
+    bkt_skills = unique_skill_ids
+    bkt_split = np.random.randint(low=0, high=5, size=len(user_vocab)).reshape(1, -1)
+
+    # Train-test split
+    users = np.arange(len(user_vocab))
+    np.random.shuffle(users)
+    split = int(train_split * len(users))
+    in_train = np.zeros(len(users), dtype=bool)
+    in_train[users[:split]] = True
+    num_train = int(lengths[in_train].sum())
+    train = create_columns(get_data_file(data_path, "train"), num_train, columns)
+    test = create_columns(get_data_file(data_path, "test"), num_rows - num_train, columns)
+
+    # Save data, text files are written chunk by chunk from the memory-mapped columns
+    sparse.save_npz(os.path.join(data_path, "q_mat.npz"), Q_mat)
+    csv_files = [open(get_data_file(data_path, split) + ".csv", "w", newline="")
+                 for split in (None, "train", "test")]
+    bkt_file = open(os.path.join(data_path, "bkt_dataset.txt"), "wb")
+    train_pos, test_pos = 0, 0
+    for k in range(0, num_rows, chunksize):
+        df = pd.DataFrame({col: full[col][k:k + chunksize] for col in columns})
+        train_mask = in_train[df["user_id"].values]
+        train_df, test_df = df[train_mask], df[~train_mask]
+        for f, split_df in zip(csv_files, (df, train_df, test_df)):
+            split_df.to_csv(f, sep="\t", index=False, header=(k == 0))
+        for split_columns, split_df, pos in ((train, train_df, train_pos), (test, test_df, test_pos)):
+            for col in columns:
+                split_columns[col][pos:pos + len(split_df)] = split_df[col].values
+        train_pos += len(train_df)
+        test_pos += len(test_df)
+        np.savetxt(bkt_file, df[["user_id", "item_id", "correct"]], fmt='%i')
+    for f in csv_files + [bkt_file]:
+        f.close()
+    np.savetxt(os.path.join(data_path, "bkt_expert_labels.txt"), bkt_skills, fmt='%i')
+    np.savetxt(os.path.join(data_path, "bkt_splits.txt"), bkt_split, fmt='%i')
+    for split, split_columns in ((None, full), ("train", train), ("test", test)):
+        for array in split_columns.values():
+            array.flush()
+        save_user_offsets(get_data_file(data_path, split), split_columns["user_id"])
+    save_vocab(data_path, {"users": user_vocab, "items": item_vocab, "skills": skills,
+                           "item_skill_ids": unique_skill_ids, "min_timestamp": min_timestamp})
+
+
+def append_interactions(data_name, raw_file, min_interactions_per_user, remove_nan_skills,
+                        kc_col_name=None, train_split=0.8):
+    """Append new raw interactions to a dataset preprocessed by an earlier run.
+
+    Ids are mapped with the vocabularies saved by the earlier run: known users, items, skills
+    and skill combinations keep their index and new ones are numbered after existing ones.
+    Only the sequences of users with new interactions, or whose items changed skills, are
+    rebuilt. Known users keep their train-test assignment and new users are split at random.
+    New users with fewer than min_interactions_per_user interactions in raw_file are dropped.
+
+    Arguments:
+        data_name (str): ASSISTments or KDD Cup 2010 dataset codename
+        raw_file (str): new interactions, same format as the dataset raw file
+        min_interactions_per_user (int): minimum number of interactions per new student
+        remove_nan_skills (bool): if True, remove interactions with no skill tag
+        kc_col_name (str): Skills id column for KDD Cup 2010 datasets, None for ASSISTments
+        train_split (float): proportion of new users to use for training
+    """
+    data_path = os.path.join("data", data_name)
+    kddcup = kc_col_name is not None
+    skill_col = kc_col_name if kddcup else "skill_id"
+    columns = list(COLUMN_DTYPES)
+
+    vocab = load_vocab(data_path)
+    old_Q_mat = sparse.load_npz(os.path.join(data_path, "q_mat.npz"))
+    old_df = load_preprocessed(data_path)[columns]
+    train_users = load_preprocessed(data_path, "train")["user_id"].unique()
+    num_old_users = len(vocab["users"])
+    old_item_skill_ids = vocab["item_skill_ids"]
+
+    if kddcup:
+        df = format_kddcup10(pd.read_csv(raw_file, delimiter='\t'))
+    else:
+        df = format_assistments(pd.read_csv(raw_file, encoding="ISO-8859-1"), data_name)
+    df["timestamp"] = shift_timestamps(df["timestamp"], vocab["min_timestamp"])
+    df = clean_interactions(df, skill_col, remove_nan_skills, 'NaN' if kddcup else -1)
+    if kddcup:
+        df = df.drop_duplicates(subset=["user_id", "item_id", "timestamp"])
+
+    # Filter too short sequences of new users
+    known_users = pd.Index(vocab["users"]).get_indexer(df["user_id"].values) >= 0
+    lengths = df.groupby("user_id")["user_id"].transform("size").values
+    df = df[known_users | (lengths >= min_interactions_per_user)]
+
+    vocab["users"], df["user_id"] = extend_vocab(vocab["users"], df["user_id"].values)
+    vocab["items"], df["item_id"] = extend_vocab(vocab["items"], df["item_id"].values)
+
+    # Add new item-skill pairs to Q-matrix
+    item_skills = df[["item_id", skill_col]].drop_duplicates()
+    if kddcup:
+        item_skills = item_skills.assign(kc=item_skills[kc_col_name].str.split('~~')).explode("kc")
+        skill_col = "kc"
+    vocab["skills"], skill_ids = extend_vocab(vocab["skills"], item_skills[skill_col].values)
+    num_items, num_skills = len(vocab["items"]), len(vocab["skills"])
+    old_Q_mat = sparse.csr_matrix((old_Q_mat.data, old_Q_mat.indices, old_Q_mat.indptr),
+                                  shape=(old_Q_mat.shape[0], num_skills))
+    old_items, old_skills = old_Q_mat.nonzero()
+    Q_mat = build_q_mat(np.concatenate((old_items, item_skills["item_id"].values)),
+                        np.concatenate((old_skills, skill_ids)), num_items, num_skills)
+    vocab["item_skill_ids"] = extend_skill_ids(old_item_skill_ids, old_Q_mat, Q_mat)
+
+    # Remove row duplicates due to multiple skills for one item
+    if data_name == "assistments09":
+        df = df.drop_duplicates("order_id")
+    df = sort_by_user(df, TIME_COLS[data_name])
+    df["skill_id"] = vocab["item_skill_ids"][df["item_id"]]
+    df = df[columns]
+
+    # Users with new interactions or with items whose unique skill id changed
+    changed_items = vocab["item_skill_ids"][:len(old_item_skill_ids)] != old_item_skill_ids
+    affected = np.zeros(len(vocab["users"]), dtype=bool)
+    affected[df["user_id"].values] = True
+    affected[old_df["user_id"].values[changed_items[old_df["item_id"].values]]] = True
+
+    # Rebuild affected sequences, new interactions go after existing ones unless timestamps say otherwise
+    affected_rows = affected[old_df["user_id"].values]
+    rebuilt_df = pd.concat((old_df[affected_rows], df))
+    if data_name == "assistments17":
+        rebuilt_df = rebuilt_df.drop_duplicates(["user_id", "timestamp"])
+    elif kddcup:
+        rebuilt_df = rebuilt_df.drop_duplicates(["user_id", "item_id", "timestamp"])
+    rebuilt_df["skill_id"] = vocab["item_skill_ids"][rebuilt_df["item_id"].values]
+    rebuilt_df = sort_by_user(rebuilt_df, "timestamp")
+
+    # Merge with untouched sequences, both are sorted by user
+    df = pd.concat((old_df[~affected_rows], rebuilt_df))
+    df = df.iloc[np.argsort(df["user_id"].values, kind="stable")]
+    df.reset_index(inplace=True, drop=True)
+
+    # Text files for BKT implementation (https://github.com/robert-lindsey/WCRP/)
+    bkt_dataset = df[["user_id", "item_id", "correct"]]
+    bkt_skills = vocab["item_skill_ids"]
+    bkt_split = np.loadtxt(os.path.join(data_path, "bkt_splits.txt"), dtype=np.int64).reshape(1, -1)
+    bkt_split = np.hstack((bkt_split, np.random.randint(low=0, high=5, size=(1, len(vocab["users"]) - num_old_users))))
+
+    # Train-test split of new users
+    new_users = np.arange(num_old_users, len(vocab["users"]))
+    np.random.shuffle(new_users)
+    split = int(train_split * len(new_users))
+    in_train = np.zeros(len(vocab["users"]), dtype=bool)
+    in_train[train_users] = True
+    in_train[new_users[:split]] = True
+    train_mask = in_train[df["user_id"].values]
+    train_df = df[train_mask]
+    test_df = df[~train_mask]
+
+    # Save data
+    sparse.save_npz(os.path.join(data_path, "q_mat.npz"), Q_mat)
+    save_preprocessed(train_df, data_path, "train")
+    save_preprocessed(test_df, data_path, "test")
+    save_preprocessed(df, data_path)
+    np.savetxt(os.path.join(data_path, "bkt_dataset.txt"), bkt_dataset, fmt='%i')
+    np.savetxt(os.path.join(data_path, "bkt_expert_labels.txt"), bkt_skills, fmt='%i')
+    np.savetxt(os.path.join(data_path, "bkt_splits.txt"), bkt_split, fmt='%i')
+    save_vocab(data_path, vocab)
 
 
 def prepare_squirrel_ai(min_interactions_per_user):
@@ -235,8 +646,8 @@ def prepare_squirrel_ai(min_interactions_per_user):
     test_df["timestamp"] = (test_df["timestamp"] - test_df["timestamp"].min()).astype(np.int64)
 
     # Filter too short sequences
-    train_df = train_df.groupby("user_id").filter(lambda x: len(x) >= min_interactions_per_user)
-    test_df = test_df.groupby("user_id").filter(lambda x: len(x) >= min_interactions_per_user)
+    train_df = filter_short_users(train_df, min_interactions_per_user)
+    test_df = filter_short_users(test_df, min_interactions_per_user)
 
     train_df["user_id"] = np.unique(train_df["user_id"], return_inverse=True)[1]
     test_df["user_id"] = np.unique(test_df["user_id"], return_inverse=True)[1] + train_df["user_id"].nunique()
@@ -244,13 +655,12 @@ def prepare_squirrel_ai(min_interactions_per_user):
     # Build Q-matrix
     num_items = max(train_df["item_id"].max(), test_df["item_id"].max()) + 1
     num_skills = max(train_df["skill_id"].max(), test_df["skill_id"].max()) + 1
-    Q_mat = np.zeros((num_items, num_skills))
-    for df in (train_df, test_df):
-        for item_id, skill_id in df[["item_id", "skill_id"]].values:
-            Q_mat[item_id, skill_id] = 1
+    Q_mat = build_q_mat(np.concatenate((train_df["item_id"].values, test_df["item_id"].values)),
+                        np.concatenate((train_df["skill_id"].values, test_df["skill_id"].values)),
+                        num_items, num_skills)
 
     # Get unique skill id from combination of all skill ids
-    unique_skill_ids = np.unique(Q_mat, axis=0, return_inverse=True)[1]
+    unique_skill_ids = get_unique_skill_ids(Q_mat)
     train_df["skill_id"] = unique_skill_ids[train_df["item_id"]]
     test_df["skill_id"] = unique_skill_ids[test_df["item_id"]]
 
@@ -268,10 +678,10 @@ def prepare_squirrel_ai(min_interactions_per_user):
     bkt_split = np.random.randint(low=0, high=5, size=df["user_id"].nunique()).reshape(1, -1)
 
     # Save data
-    sparse.save_npz(os.path.join(data_path, "q_mat.npz"), sparse.csr_matrix(Q_mat))
-    train_df.to_csv(os.path.join(data_path, f"preprocessed_data_train.csv"), sep="\t", index=False)
-    test_df.to_csv(os.path.join(data_path, f"preprocessed_data_test.csv"), sep="\t", index=False)
-    df.to_csv(os.path.join(data_path, f"preprocessed_data.csv"), sep="\t", index=False)
+    sparse.save_npz(os.path.join(data_path, "q_mat.npz"), Q_mat)
+    save_preprocessed(train_df, data_path, "train")
+    save_preprocessed(test_df, data_path, "test")
+    save_preprocessed(df, data_path)
     np.savetxt(os.path.join(data_path, "bkt_dataset.txt"), bkt_dataset, fmt='%i')
     np.savetxt(os.path.join(data_path, "bkt_expert_labels.txt"), bkt_skills, fmt='%i')
     np.savetxt(os.path.join(data_path, "bkt_splits.txt"), bkt_split, fmt='%i')
@@ -302,12 +712,11 @@ def prepare_spanish(train_split=0.8):
     df.reset_index(inplace=True, drop=True)
 
     # Build Q-matrix
-    Q_mat = np.zeros((df["item_id"].nunique(), df["skill_id"].nunique()))
-    for item_id, skill_id in df[["item_id", "skill_id"]].values:
-        Q_mat[item_id, skill_id] = 1
+    Q_mat = build_q_mat(df["item_id"].values, df["skill_id"].values,
+                        df["item_id"].nunique(), df["skill_id"].nunique())
 
     # Sort data by users, preserving temporal order for each user
-    df = pd.concat([u_df for _, u_df in df.groupby("user_id")])
+    df = sort_by_user(df)
 
     # Train-test split
     users = df["user_id"].unique()
@@ -317,10 +726,10 @@ def prepare_spanish(train_split=0.8):
     test_df = df[df["user_id"].isin(users[split:])]
 
     # Save data
-    sparse.save_npz(os.path.join(data_path, "q_mat.npz"), sparse.csr_matrix(Q_mat))
-    train_df.to_csv(os.path.join(data_path, "preprocessed_data_train.csv"), sep="\t", index=False)
-    test_df.to_csv(os.path.join(data_path, "preprocessed_data_test.csv"), sep="\t", index=False)
-    df.to_csv(os.path.join(data_path, "preprocessed_data.csv"), sep="\t", index=False)
+    sparse.save_npz(os.path.join(data_path, "q_mat.npz"), Q_mat)
+    save_preprocessed(train_df, data_path, "train")
+    save_preprocessed(test_df, data_path, "test")
+    save_preprocessed(df, data_path)
 
 
 if __name__ == "__main__":
@@ -328,24 +737,46 @@ if __name__ == "__main__":
     parser.add_argument('--dataset', type=str, default='assistments09')
     parser.add_argument('--min_interactions', type=int, default=10)
     parser.add_argument('--remove_nan_skills', action='store_true')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='If set, read the raw file by chunks of this many rows and '
+                             'preprocess out of core (ASSISTments and KDD Cup 2010 only).')
+    parser.add_argument('--num_buckets', type=int, default=32,
+                        help='Number of temporary user partitions used out of core.')
+    parser.add_argument('--append', type=str, default=None,
+                        help='If set, raw file of new interactions to append to the preprocessed '
+                             'dataset, keeping existing ids (ASSISTments and KDD Cup 2010 only).')
     args = parser.parse_args()
 
-    if args.dataset in ["assistments09", "assistments12", "assistments15", "assistments17"]:
-        prepare_assistments(
+    if (args.chunksize is not None or args.append is not None) and args.dataset not in TIME_COLS:
+        parser.error(f"--chunksize and --append support {', '.join(TIME_COLS)}, not {args.dataset}")
+
+    kc_col_names = {"bridge_algebra06": "KC(SubSkills)", "algebra05": "KC(Default)"}
+
+    if args.append is not None:
+        append_interactions(
             data_name=args.dataset,
+            raw_file=args.append,
             min_interactions_per_user=args.min_interactions,
-            remove_nan_skills=args.remove_nan_skills)
-    elif args.dataset == "bridge_algebra06":
-        prepare_kddcup10(
-            data_name="bridge_algebra06",
+            remove_nan_skills=args.remove_nan_skills,
+            kc_col_name=kc_col_names.get(args.dataset))
+    elif args.chunksize is not None:
+        prepare_out_of_core(
+            data_name=args.dataset,
+            min_interactions_per_user=args.min_interactions,
+            remove_nan_skills=args.remove_nan_skills,
+            kc_col_name=kc_col_names.get(args.dataset),
+            chunksize=args.chunksize,
+            num_buckets=args.num_buckets)
+    elif args.dataset in ["assistments09", "assistments12", "assistments15", "assistments17"]:
+        prepare_assistments(
+            data_name=args.dataset,
             min_interactions_per_user=args.min_interactions,
-            kc_col_name="KC(SubSkills)",
             remove_nan_skills=args.remove_nan_skills)
-    elif args.dataset == "algebra05":
+    elif args.dataset in ["bridge_algebra06", "algebra05"]:
         prepare_kddcup10(
-            data_name="algebra05",
+            data_name=args.dataset,
             min_interactions_per_user=args.min_interactions,
-            kc_col_name="KC(Default)",
+            kc_col_name=kc_col_names[args.dataset],
             remove_nan_skills=args.remove_nan_skills)
     elif args.dataset == "squirrel_ai":
         prepare_squirrel_ai(
@@ -0,0 +1,131 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from multiprocessing import Pool
+from sklearn.linear_model import LogisticRegression
+
+from train_lr import compute_metrics
+from utils.data import (expand_ranges, get_meta_path, get_rows, get_user_ranges, load_column_blocks, load_columns,
+                        load_encoded_mmap, load_encoded_user_offsets, load_preprocessed)
+
+
+# Shared by the processes of the pool, set by init_worker
+worker_data = {}
+
+
+def get_columns(column_blocks, feature_set):
+    """Columns of the feature blocks selected by a feature set.
+
+    Arguments:
+        column_blocks (pandas DataFrame): output by load_column_blocks
+        feature_set (str): comma separated block names, a name also selects the blocks it
+            prefixes, e.g. "a" selects "a-sc", "a-ic" and "a-tc", "all" selects every block
+
+    Output:
+        columns (array of int): sorted columns of X
+    """
+    names = feature_set.split(",")
+    selected = [row for row in column_blocks.itertuples()
+                if feature_set == "all" or any(row.name == x or row.name.startswith(x + "-") for x in names)]
+    assert len(selected) > 0, f"No feature block matches {feature_set}"
+    return np.concatenate([np.arange(row.start, row.stop) for row in selected])
+
+
+def read_columns(X, ranges, columns, block_size):
+    """Read the rows of a split restricted to some columns, block by block.
+
+    Only one block of full rows is in memory at a time, the output holds the selected columns.
+
+    Arguments:
+        X (dict): memory-mapped feature matrix output by load_encoded_mmap
+        ranges (tuple): starts and lengths of the row ranges of a split, see get_user_ranges
+        columns (array of int): output by get_columns
+        block_size (int): number of rows read at a time
+
+    Output:
+        X_split (sparse array): csr matrix of shape (number of rows of the split, len(columns))
+    """
+    rows = expand_ranges(*ranges)
+    return sparse.vstack([get_rows(X, rows[k:k + block_size])[:, columns]
+                          for k in range(0, len(rows), block_size)], format="csr")
+
+
+def init_worker(X_file, train, test):
+    """Memory-map X in each process, pages are shared between processes by the OS."""
+    worker_data["X"] = load_encoded_mmap(X_file)
+    worker_data["labels"] = load_columns(get_meta_path(X_file))["correct"]
+    worker_data["column_blocks"] = load_column_blocks(X_file)
+    worker_data["train"], worker_data["test"] = train, test
+
+
+def fit_path(feature_set, Cs, max_iter, block_size):
+    """Fit logistic regression on a feature set along a regularization path with warm starts.
+
+    X is shared through the memory map, but lbfgs needs the rows of each split in memory, so
+    every worker holds its own copy of the train and test rows restricted to the feature set.
+
+    Arguments:
+        feature_set (str): see get_columns
+        Cs (list of float): inverses of regularization strength
+        max_iter (int): maximum number of lbfgs iterations per fit
+        block_size (int): number of rows read at a time, see read_columns
+
+    Output:
+        results (list of dict): features, C and metrics of each fit
+    """
+    X, labels = worker_data["X"], worker_data["labels"]
+    train, test = worker_data["train"], worker_data["test"]
+    columns = get_columns(worker_data["column_blocks"], feature_set)
+    X_train, X_test = read_columns(X, train, columns, block_size), read_columns(X, test, columns, block_size)
+    y_train, y_test = labels[expand_ranges(*train)], labels[expand_ranges(*test)]
+
+    # Increasing C, each fit starts from the more regularized solution
+    model = LogisticRegression(solver="lbfgs", max_iter=max_iter, warm_start=True)
+    results = []
+    for C in sorted(Cs):
+        model.set_params(C=C)
+        model.fit(X_train, y_train)
+        acc_train, auc_train, nll_train, mse_train = compute_metrics(model.predict_proba(X_train)[:, 1], y_train)
+        acc_test, auc_test, nll_test, mse_test = compute_metrics(model.predict_proba(X_test)[:, 1], y_test)
+        results.append({"features": feature_set, "C": C, "num_features": len(columns),
+                        "acc_train": acc_train, "auc_train": auc_train, "nll_train": nll_train,
+                        "mse_train": mse_train, "acc_test": acc_test, "auc_test": auc_test,
+                        "nll_test": nll_test, "mse_test": mse_test})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sweep regularization and feature sets of logistic regression.')
+    parser.add_argument('--X_file', type=str)
+    parser.add_argument('--dataset', type=str)
+    parser.add_argument('--C', type=float, nargs='+', default=[0.01, 0.1, 1.0, 10.0])
+    parser.add_argument('--feature_sets', type=str, nargs='+', default=["all"],
+                        help='comma separated feature block names, e.g. "i,s,a-sc,w-sc"')
+    parser.add_argument('--iter', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes fitting feature sets in parallel, each one holds '
+                             'the train and test rows of its feature set in memory')
+    parser.add_argument('--block_size', type=int, default=10000,
+                        help='number of rows read at a time from the memory-mapped matrix')
+    args = parser.parse_args()
+
+    features_suffix = (args.X_file.split("-")[-1]).split(".")[0]
+
+    data_path = os.path.join('data', args.dataset)
+    train_df = load_preprocessed(data_path, "train")
+    test_df = load_preprocessed(data_path, "test")
+
+    # Student-wise train-test split, selecting row ranges of users
+    offsets, users = load_encoded_user_offsets(args.X_file)
+    train = get_user_ranges(offsets, users, train_df["user_id"].unique())
+    test = get_user_ranges(offsets, users, test_df["user_id"].unique())
+
+    tasks = [(feature_set, args.C, args.iter, args.block_size) for feature_set in args.feature_sets]
+    with Pool(args.workers, initializer=init_worker, initargs=(args.X_file, train, test)) as pool:
+        results = pd.DataFrame([r for path in pool.starmap(fit_path, tasks) for r in path])
+
+    results_file = os.path.join(data_path, f"sweep-{features_suffix}.csv")
+    results.to_csv(results_file, sep="\t", index=False)
+    print(results.to_string(index=False))
@@ -1,11 +1,8 @@
 import argparse
-import pandas as pd
-from random import shuffle
-from sklearn.metrics import roc_auc_score, accuracy_score
+from sklearn.metrics import roc_auc_score
 
 import torch.nn as nn
 from torch.optim import Adam
-from torch.nn.utils.rnn import pad_sequence
 
 from model_dkt1 import DKT1
 from utils import *
@@ -15,7 +12,8 @@ def cuda(tensor):
     return tensor.cuda() if tensor is not None else None
 
 
-def get_data(df, item_in, skill_in, item_out, skill_out, skill_separate, train_split=0.8, randomize=True):
+def get_data(df, item_in, skill_in, item_out, skill_out, skill_separate, train_split=0.8, randomize=True,
+             offsets=None):
     """Extract sequences from dataframe.
 
     Arguments:
@@ -24,143 +22,122 @@ def get_data(df, item_in, skill_in, item_out, skill_out, skill_separate, train_s
         skill_in (bool): if True, use skills as inputs
         item_out (bool): if True, use items as outputs
         skill_out (bool): if True, use skills as outputs
+        skill_separate (bool): if True, one sequence per user and skill
         train_split (float): proportion of data to use for training
+        offsets (array of int): user sequence offsets output by prepare_data.py,
+            computed from df if None
     """
-    idx = ["user_id", "skill_id"] if skill_separate else "user_id"
-    item_ids = [torch.tensor(u_df["item_id"].values, dtype=torch.long)
-                for _, u_df in df.groupby(idx)]
-    skill_ids = [torch.tensor(u_df["skill_id"].values, dtype=torch.long)
-                 for _, u_df in df.groupby(idx)]
-    labels = [torch.tensor(u_df["correct"].values, dtype=torch.long)
-              for _, u_df in df.groupby(idx)]
-
-    item_inputs = [torch.cat((torch.zeros(1, dtype=torch.long), i * 2 + l + 1))[:-1]
-                   for (i, l) in zip(item_ids, labels)]
-    skill_inputs = [torch.cat((torch.zeros(1, dtype=torch.long), s * 2 + l + 1))[:-1]
-                    for (s, l) in zip(skill_ids, labels)]
-
-    item_inputs = item_inputs if item_in else [None] * len(item_inputs)
-    skill_inputs = skill_inputs if skill_in else [None] * len(skill_inputs)
-    item_ids = item_ids if item_out else [None] * len(item_ids)
-    skill_ids = skill_ids if skill_out else [None] * len(skill_ids)
-
-    data = list(zip(item_inputs, skill_inputs, item_ids, skill_ids, labels))
-    if randomize:
-        shuffle(data)
+    user_ids = df["user_id"].values
+    item_ids = df["item_id"].values
+    skill_ids = df["skill_id"].values
+    labels = df["correct"].values
+
+    if skill_separate:
+        # Sequences of each (user, skill) pair, in the same order as groupby
+        order = np.lexsort((skill_ids, user_ids))
+        user_ids, item_ids, skill_ids, labels = [x[order] for x in (user_ids, item_ids, skill_ids, labels)]
+        offsets = get_user_offsets(user_ids.astype(np.int64) * (skill_ids.max() + 1) + skill_ids)
+    elif offsets is None:
+        offsets = get_user_offsets(user_ids)
+
+    item_ids = torch.tensor(item_ids, dtype=torch.int)
+    skill_ids = torch.tensor(skill_ids, dtype=torch.int)
+    labels = torch.tensor(labels, dtype=torch.int)
+
+    # Shift inputs by one interaction within each sequence
+    shifted = [torch.cat((torch.zeros(1, dtype=torch.int), x[:-1])) for x in (item_ids * 2 + labels + 1,
+                                                                               skill_ids * 2 + labels + 1)]
+    for x in shifted:
+        x[offsets[:-1]] = 0
+    item_inputs, skill_inputs = shifted
+
+    item_inputs = item_inputs if item_in else None
+    skill_inputs = skill_inputs if skill_in else None
+    item_ids = item_ids if item_out else None
+    skill_ids = skill_ids if skill_out else None
+
+    data = SequenceDataset.from_offsets([item_inputs, skill_inputs, item_ids, skill_ids, labels], offsets,
+                                        pad_values=[0, 0, 0, 0, -1])  # Pad labels with -1
 
     # Train-test split across users
-    train_size = int(train_split * len(data))
-    train_data, val_data = data[:train_size], data[train_size:]
-    return train_data, val_data
+    return data.split(train_split, randomize)
 
 
-def prepare_batches(data, batch_size, randomize=True):
-    """Prepare batches grouping padded sequences.
+def get_output_ids(item_ids, skill_ids):
+    """Item or skill queried at each timestep, whichever is used as output."""
+    return item_ids if item_ids is not None else skill_ids
 
-    Arguments:
-        data (list of lists of torch Tensor): output by get_data
-        batch_size (int): number of sequences per batch
-
-    Output:
-        batches (list of lists of torch Tensor)
-    """
-    if randomize:
-        shuffle(data)
-    batches = []
-
-    for k in range(0, len(data), batch_size):
-        batch = data[k:k + batch_size]
-        seq_lists = list(zip(*batch))
-        inputs_and_ids = [pad_sequence(seqs, batch_first=True, padding_value=0)
-                          if (seqs[0] is not None) else None for seqs in seq_lists[:4]]
-        labels = pad_sequence(seq_lists[-1], batch_first=True, padding_value=-1)  # Pad labels with -1
-        batches.append([*inputs_and_ids, labels])
-
-    return batches
 
-
-def get_preds(preds, item_ids, skill_ids, labels):
+def compute_loss(preds, labels, criterion):
     preds = preds[labels >= 0]
-
-    if (item_ids is not None):
-        item_ids = item_ids[labels >= 0]
-        preds = preds[torch.arange(preds.size(0)), item_ids]
-    elif (skill_ids is not None):
-        skill_ids = skill_ids[labels >= 0]
-        preds = preds[torch.arange(preds.size(0)), skill_ids]
-
-    return preds
-
-
-def compute_auc(preds, item_ids, skill_ids, labels):
-    preds = get_preds(preds, item_ids, skill_ids, labels)
-    labels = labels[labels >= 0].float()
-
-    if len(torch.unique(labels)) == 1:  # Only one class
-        auc = accuracy_score(labels, preds.round())
-    else:
-        auc = roc_auc_score(labels, preds)
-
-    return auc
-
-
-def compute_loss(preds, item_ids, skill_ids, labels, criterion):
-    preds = get_preds(preds, item_ids, skill_ids, labels)
     labels = labels[labels >= 0].float()
     return criterion(preds, labels)
 
 
-def train(train_data, val_data, model, optimizer, logger, saver, num_epochs, batch_size, bptt=50):
+def train(train_data, val_data, model, optimizer, logger, saver, num_epochs, batch_size, bptt=50, bucket_size=None,
+          packed=False):
     """Train DKT model.
     
     Arguments:
-        train_data (list of lists of torch Tensor)
-        val_data (list of lists of torch Tensor)
+        train_data (SequenceDataset)
+        val_data (SequenceDataset)
         model (torch Module)
         optimizer (torch optimizer)
         logger: wrapper for TensorboardX logger
         saver: wrapper for torch saving
         num_epochs (int): number of epochs to train for
         batch_size (int)
-        bptt (int): length of truncated backprop through time chunks
+        bptt (int): length of truncated backprop through time chunks, whose loss is backpropagated
+            as soon as they are computed
+        bucket_size (int): if not None, batch sequences of similar lengths, see SequenceDataset.batches
+        packed (bool): if True, run the LSTM on packed sequences
         savepath (str): directory where to save the trained model
     """
-    criterion = nn.BCEWithLogitsLoss()
+    criterion = nn.BCEWithLogitsLoss(reduction='sum')
     metrics = Metrics()
     step = 0
     
     for epoch in range(num_epochs):
-        train_batches = prepare_batches(train_data, batch_size)
-        val_batches = prepare_batches(val_data, batch_size)
+        train_batches = train_data.batches(batch_size, bucket_size=bucket_size)
+        val_batches = val_data.batches(batch_size, bucket_size=bucket_size)
 
         # Training
         for item_inputs, skill_inputs, item_ids, skill_ids, labels in train_batches:
             length = labels.size(1)
-            preds = torch.empty(labels.size(0), length, model.output_size)
-            preds = preds.cuda()
             item_inputs = cuda(item_inputs)
             skill_inputs = cuda(skill_inputs)
-
-            # Truncated backprop through time
+            output_ids = cuda(get_output_ids(item_ids, skill_ids))
+            lengths = (labels >= 0).sum(1)
+            labels = labels.cuda()
+            num_labels = (labels >= 0).sum()
+            loss = 0
+
+            # Truncated backprop through time, backpropagating the loss of each chunk as it is
+            # computed. Gradients accumulate to those of the mean loss over the batch, since the
+            # hidden state is detached between chunks.
+            model.zero_grad()
             for i in range(0, length, bptt):
                 item_inp = item_inputs[:, i:i + bptt] if item_inputs is not None else None
                 skill_inp = skill_inputs[:, i:i + bptt] if skill_inputs is not None else None
+                output_ids_inp = output_ids[:, i:i + bptt]
+                # Sequences that already ended keep one padded step, packing needs nonzero lengths
+                chunk_lengths = (lengths - i).clamp(1, bptt) if packed else None
                 if i == 0:
-                    pred, hidden = model(item_inp, skill_inp)
+                    pred, hidden = model(item_inp, skill_inp, lengths=chunk_lengths, output_ids=output_ids_inp)
                 else:
                     hidden = model.repackage_hidden(hidden)
-                    pred, hidden = model(item_inp, skill_inp, hidden)
-                preds[:, i:i + bptt] = pred
+                    pred, hidden = model(item_inp, skill_inp, hidden, chunk_lengths, output_ids_inp)
 
-            loss = compute_loss(preds, item_ids, skill_ids, labels.cuda(), criterion)
-            train_auc = compute_auc(torch.sigmoid(preds).detach().cpu(), item_ids, skill_ids, labels)
+                chunk_labels = labels[:, i:i + bptt]
+                chunk_loss = compute_loss(pred, chunk_labels, criterion) / num_labels
+                chunk_loss.backward()
+                loss += chunk_loss.detach()
+                metrics.store_predictions('train', torch.sigmoid(pred.detach()), chunk_labels)
 
-            model.zero_grad()
-            loss.backward()
             optimizer.step()
             step += 1
-            metrics.store({'loss/train': loss.item()})
-            metrics.store({'auc/train': train_auc})
+            metrics.store({'loss/train': loss.detach()})
+            metrics.store({'padding_efficiency/train': (labels >= 0).float().mean()})
 
             # Logging
             if step % 20 == 0:
@@ -177,9 +154,10 @@ def train(train_data, val_data, model, optimizer, logger, saver, num_epochs, bat
             with torch.no_grad():
                 item_inputs = cuda(item_inputs)
                 skill_inputs = cuda(skill_inputs)
-                preds, _ = model(item_inputs, skill_inputs)
-            val_auc = compute_auc(torch.sigmoid(preds).cpu(), item_ids, skill_ids, labels)
-            metrics.store({'auc/val': val_auc})
+                lengths = (labels >= 0).sum(1) if packed else None
+                output_ids = cuda(get_output_ids(item_ids, skill_ids))
+                preds, _ = model(item_inputs, skill_inputs, lengths=lengths, output_ids=output_ids)
+            metrics.store_predictions('val', torch.sigmoid(preds), labels)
         model.train()
 
         # Save model
@@ -209,6 +187,10 @@ if __name__ == "__main__":
     parser.add_argument('--num_hid_layers', type=int, default=1)
     parser.add_argument('--drop_prob', type=float, default=0.5)
     parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--bucket_size', type=int, default=None,
+                        help='number of batches per length-sorted pool, no bucketing if not set')
+    parser.add_argument('--packed', action='store_true',
+                        help='If True, run the LSTM on packed sequences to skip padding.')
     parser.add_argument('--lr', type=float, default=1e-2)
     parser.add_argument('--num_epochs', type=int, default=300)
     args = parser.parse_args()
@@ -216,12 +198,14 @@ if __name__ == "__main__":
     assert (args.item_in or args.skill_in)    # Use at least one of skills or items as input
     assert (args.item_out != args.skill_out)  # Use exactly one of skills or items as output
 
-    full_df = pd.read_csv(os.path.join('data', args.dataset, 'preprocessed_data.csv'), sep="\t")
-    train_df = pd.read_csv(os.path.join('data', args.dataset, 'preprocessed_data_train.csv'), sep="\t")
-    test_df = pd.read_csv(os.path.join('data', args.dataset, 'preprocessed_data_test.csv'), sep="\t")
+    data_path = os.path.join('data', args.dataset)
+    full_df = load_preprocessed(data_path)
+    train_df = load_preprocessed(data_path, "train")
+    test_df = load_preprocessed(data_path, "test")
 
     train_data, val_data = get_data(train_df, args.item_in, args.skill_in, args.item_out,
-                                    args.skill_out, args.skill_separate)
+                                    args.skill_out, args.skill_separate,
+                                    offsets=load_user_offsets(data_path, "train"))
 
     num_items = int(full_df["item_id"].max() + 1) + 1
     num_skills = int(full_df["skill_id"].max() + 1) + 1
@@ -243,7 +227,8 @@ if __name__ == "__main__":
                          f'skill_separate={args.skill_separate}')
             logger = Logger(os.path.join(args.logdir, param_str))
             saver = Saver(args.savedir, param_str)
-            train(train_data, val_data, model, optimizer, logger, saver, args.num_epochs, args.batch_size)
+            train(train_data, val_data, model, optimizer, logger, saver, args.num_epochs, args.batch_size,
+                  bucket_size=args.bucket_size, packed=args.packed)
             break
         except RuntimeError:
             args.batch_size = args.batch_size // 2
@@ -254,8 +239,8 @@ if __name__ == "__main__":
     model = saver.load()
     test_data, _ = get_data(test_df, args.item_in, args.skill_in, args.item_out,
                             args.skill_out, args.skill_separate, train_split=1.0,
-                            randomize=False)
-    test_batches = prepare_batches(test_data, args.batch_size, randomize=False)
+                            randomize=False, offsets=load_user_offsets(data_path, "test"))
+    test_batches = test_data.batches(args.batch_size, randomize=False)
     test_preds = np.empty(0)
 
     # Predict on test set
@@ -264,13 +249,15 @@ if __name__ == "__main__":
         with torch.no_grad():
             item_inputs = cuda(item_inputs)
             skill_inputs = cuda(skill_inputs)
-            preds, _ = model(item_inputs, skill_inputs)
-            preds = torch.sigmoid(get_preds(preds, item_ids, skill_ids, labels)).cpu().numpy()
+            lengths = (labels >= 0).sum(1) if args.packed else None
+            output_ids = cuda(get_output_ids(item_ids, skill_ids))
+            preds, _ = model(item_inputs, skill_inputs, lengths=lengths, output_ids=output_ids)
+            preds = torch.sigmoid(preds[labels >= 0]).cpu().numpy()
             test_preds = np.concatenate([test_preds, preds])
 
     # Write predictions to csv
     test_df["DKT1"] = test_preds
-    test_df.to_csv(f'data/{args.dataset}/preprocessed_data_test.csv', sep="\t", index=False)
+    save_preprocessed(test_df, data_path, "test")
 
     print("auc_test = ", roc_auc_score(test_df["correct"], test_preds))
 
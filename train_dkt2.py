@@ -1,77 +1,39 @@
 import argparse
-import pandas as pd
-from random import shuffle
-from sklearn.metrics import roc_auc_score, accuracy_score
+from sklearn.metrics import roc_auc_score
 
 import torch.nn as nn
 from torch.optim import Adam
-from torch.nn.utils.rnn import pad_sequence
 
 from model_dkt2 import DKT2
 from utils import *
 
 
-def get_data(df, train_split=0.8, randomize=True):
+def get_data(df, train_split=0.8, randomize=True, offsets=None):
     """Extract sequences from dataframe.
 
     Arguments:
         df (pandas Dataframe): output by prepare_data.py
         train_split (float): proportion of data to use for training
+        offsets (array of int): user sequence offsets output by prepare_data.py,
+            computed from df if None
     """
-    item_ids = [torch.tensor(u_df["item_id"].values, dtype=torch.long)
-                for _, u_df in df.groupby("user_id")]
-    skill_ids = [torch.tensor(u_df["skill_id"].values, dtype=torch.long)
-                 for _, u_df in df.groupby("user_id")]
-    labels = [torch.tensor(u_df["correct"].values, dtype=torch.long)
-              for _, u_df in df.groupby("user_id")]
+    if offsets is None:
+        offsets = get_user_offsets(df["user_id"].values)
 
-    item_inputs = [torch.cat((torch.zeros(1, dtype=torch.long), i))[:-1] for i in item_ids]
-    skill_inputs = [torch.cat((torch.zeros(1, dtype=torch.long), s))[:-1] for s in skill_ids]
-    label_inputs = [torch.cat((torch.zeros(1, dtype=torch.long), l))[:-1] for l in labels]
+    item_ids = torch.tensor(df["item_id"].values, dtype=torch.int)
+    skill_ids = torch.tensor(df["skill_id"].values, dtype=torch.int)
+    labels = torch.tensor(df["correct"].values, dtype=torch.int)
 
-    data = list(zip(item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, labels))
-    if randomize:
-        shuffle(data)
+    # Shift inputs by one interaction within each sequence
+    shifted = [torch.cat((torch.zeros(1, dtype=torch.int), x[:-1])) for x in (item_ids, skill_ids, labels)]
+    for x in shifted:
+        x[offsets[:-1]] = 0
 
-    # Train-test split across users
-    train_size = int(train_split * len(data))
-    train_data, val_data = data[:train_size], data[train_size:]
-    return train_data, val_data
-
-
-def prepare_batches(data, batch_size, randomize=True):
-    """Prepare batches grouping padded sequences.
-
-    Arguments:
-        data (list of lists of torch Tensor): output by get_data
-        batch_size (int): number of sequences per batch
-
-    Output:
-        batches (list of lists of torch Tensor)
-    """
-    if randomize:
-        shuffle(data)
-    batches = []
+    data = SequenceDataset.from_offsets([*shifted, item_ids, skill_ids, labels], offsets,
+                                        pad_values=[0, 0, 0, 0, 0, -1])  # Pad labels with -1
 
-    for k in range(0, len(data), batch_size):
-        batch = data[k:k + batch_size]
-        seq_lists = list(zip(*batch))
-        inputs_and_ids = [pad_sequence(seqs, batch_first=True, padding_value=0)
-                          for seqs in seq_lists[:-1]]
-        labels = pad_sequence(seq_lists[-1], batch_first=True, padding_value=-1)  # Pad labels with -1
-        batches.append([*inputs_and_ids, labels])
-
-    return batches
-
-
-def compute_auc(preds, labels):
-    preds = preds[labels >= 0].flatten()
-    labels = labels[labels >= 0].float()
-    if len(torch.unique(labels)) == 1:  # Only one class
-        auc = accuracy_score(labels, preds.round())
-    else:
-        auc = roc_auc_score(labels, preds)
-    return auc
+    # Train-test split across users
+    return data.split(train_split, randomize)
 
 
 def compute_loss(preds, labels, criterion):
@@ -80,26 +42,29 @@ def compute_loss(preds, labels, criterion):
     return criterion(preds, labels)
 
 
-def train(train_data, val_data, model, optimizer, logger, saver, num_epochs, batch_size):
+def train(train_data, val_data, model, optimizer, logger, saver, num_epochs, batch_size, bucket_size=None,
+          packed=False):
     """Train DKT model.
 
     Arguments:
-        train_data (list of lists of torch Tensor)
-        val_data (list of lists of torch Tensor)
+        train_data (SequenceDataset)
+        val_data (SequenceDataset)
         model (torch Module)
         optimizer (torch optimizer)
         logger: wrapper for TensorboardX logger
         saver: wrapper for torch saving
         num_epochs (int): number of epochs to train for
         batch_size (int)
+        bucket_size (int): if not None, batch sequences of similar lengths, see SequenceDataset.batches
+        packed (bool): if True, run the LSTM on packed sequences
     """
     criterion = nn.BCEWithLogitsLoss()
     metrics = Metrics()
     step = 0
 
     for epoch in range(num_epochs):
-        train_batches = prepare_batches(train_data, batch_size)
-        val_batches = prepare_batches(val_data, batch_size)
+        train_batches = train_data.batches(batch_size, bucket_size=bucket_size)
+        val_batches = val_data.batches(batch_size, bucket_size=bucket_size)
 
         # Training
         for item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, labels in train_batches:
@@ -108,17 +73,19 @@ def train(train_data, val_data, model, optimizer, logger, saver, num_epochs, bat
             label_inputs = label_inputs.cuda()
             item_ids = item_ids.cuda()
             skill_ids = skill_ids.cuda()
-            preds = model(item_inputs, skill_inputs, label_inputs, item_ids, skill_ids)
+            lengths = (labels >= 0).sum(1) if packed else None
+            labels = labels.cuda()
+            preds = model(item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, lengths)
 
-            loss = compute_loss(preds, labels.cuda(), criterion)
-            train_auc = compute_auc(torch.sigmoid(preds).detach().cpu(), labels)
+            loss = compute_loss(preds, labels, criterion)
 
             model.zero_grad()
             loss.backward()
             optimizer.step()
             step += 1
-            metrics.store({'loss/train': loss.item()})
-            metrics.store({'auc/train': train_auc})
+            metrics.store({'loss/train': loss.detach()})
+            metrics.store({'padding_efficiency/train': (labels >= 0).float().mean()})
+            metrics.store_predictions('train', torch.sigmoid(preds), labels)
 
             # Logging
             if step % 20 == 0:
@@ -133,9 +100,9 @@ def train(train_data, val_data, model, optimizer, logger, saver, num_epochs, bat
                 label_inputs = label_inputs.cuda()
                 item_ids = item_ids.cuda()
                 skill_ids = skill_ids.cuda()
-                preds = model(item_inputs, skill_inputs, label_inputs, item_ids, skill_ids)
-            val_auc = compute_auc(torch.sigmoid(preds).cpu(), labels)
-            metrics.store({'auc/val': val_auc})
+                lengths = (labels >= 0).sum(1) if packed else None
+                preds = model(item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, lengths)
+            metrics.store_predictions('val', torch.sigmoid(preds), labels)
         model.train()
 
         # Save model
@@ -156,6 +123,10 @@ if __name__ == "__main__":
     parser.add_argument('--num_hid_layers', type=int, default=1)
     parser.add_argument('--drop_prob', type=float, default=0.5)
     parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--bucket_size', type=int, default=None,
+                        help='number of batches per length-sorted pool, no bucketing if not set')
+    parser.add_argument('--packed', action='store_true',
+                        help='If True, run the LSTM on packed sequences to skip padding.')
     parser.add_argument('--lr', type=float, default=1e-2)
     parser.add_argument('--num_epochs', type=int, default=100)
     parser.add_argument('--seed', type=int, default=0)
@@ -163,11 +134,13 @@ if __name__ == "__main__":
 
     set_random_seeds(args.seed)
 
-    full_df = pd.read_csv(os.path.join('data', args.dataset, 'preprocessed_data.csv'), sep="\t")
-    train_df = pd.read_csv(os.path.join('data', args.dataset, 'preprocessed_data_train.csv'), sep="\t")
-    test_df = pd.read_csv(os.path.join('data', args.dataset, 'preprocessed_data_test.csv'), sep="\t")
+    data_path = os.path.join('data', args.dataset)
+    full_df = load_preprocessed(data_path)
+    train_df = load_preprocessed(data_path, "train")
+    test_df = load_preprocessed(data_path, "test")
 
-    train_data, val_data = get_data(train_df, train_split=0.8)
+    train_data, val_data = get_data(train_df, train_split=0.8,
+                                    offsets=load_user_offsets(data_path, "train"))
 
     model = DKT2(int(full_df["item_id"].max()), int(full_df["skill_id"].max()), args.hid_size,
                  args.embed_size, args.num_hid_layers, args.drop_prob).cuda()
@@ -180,7 +153,8 @@ if __name__ == "__main__":
             param_str = f"{args.dataset}"
             logger = Logger(os.path.join(args.logdir, param_str))
             saver = Saver(args.savedir, param_str)
-            train(train_data, val_data, model, optimizer, logger, saver, args.num_epochs, args.batch_size)
+            train(train_data, val_data, model, optimizer, logger, saver, args.num_epochs, args.batch_size,
+                  bucket_size=args.bucket_size, packed=args.packed)
             break
         except RuntimeError:
             args.batch_size = args.batch_size // 2
@@ -189,8 +163,9 @@ if __name__ == "__main__":
     logger.close()
 
     model = saver.load()
-    test_data, _ = get_data(test_df, train_split=1.0, randomize=False)
-    test_batches = prepare_batches(test_data, args.batch_size, randomize=False)
+    test_data, _ = get_data(test_df, train_split=1.0, randomize=False,
+                            offsets=load_user_offsets(data_path, "test"))
+    test_batches = test_data.batches(args.batch_size, randomize=False)
     test_preds = np.empty(0)
 
     # Predict on test set
@@ -202,12 +177,13 @@ if __name__ == "__main__":
             label_inputs = label_inputs.cuda()
             item_ids = item_ids.cuda()
             skill_ids = skill_ids.cuda()
-            preds = model(item_inputs, skill_inputs, label_inputs, item_ids, skill_ids)
+            lengths = (labels >= 0).sum(1) if args.packed else None
+            preds = model(item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, lengths)
             preds = torch.sigmoid(preds[labels >= 0]).cpu().numpy()
             test_preds = np.concatenate([test_preds, preds])
 
     # Write predictions to csv
     test_df["DKT2"] = test_preds
-    test_df.to_csv(f'data/{args.dataset}/preprocessed_data_test.csv', sep="\t", index=False)
+    save_preprocessed(test_df, data_path, "test")
 
     print("auc_test = ", roc_auc_score(test_df["correct"], test_preds))
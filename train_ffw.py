@@ -1,6 +1,4 @@
 import argparse
-import pandas as pd
-from scipy.sparse import load_npz, csr_matrix
 from sklearn.metrics import roc_auc_score
 
 import torch.nn as nn
@@ -10,31 +8,60 @@ from model_ffw import FeedForward
 from utils import *
 
 
-def get_tensors(sparse):
-    # First 5 columns are the original dataset, including label in column 3
-    dense = torch.tensor(sparse.toarray())
-    inputs = dense[:, 5:].float()
-    labels = dense[:, 3].float()
+def get_tensors(X, labels):
+    """Convert csr rows to the column indices, row offsets and values input by FeedForward."""
+    inputs = (torch.tensor(X.indices, dtype=torch.long),
+              torch.tensor(X.indptr[:-1], dtype=torch.long),
+              torch.tensor(X.data, dtype=torch.float))
+    labels = torch.tensor(labels).float()
     return inputs, labels
 
 
-def train_ffw(train, val, model, optimizer, logger, saver, num_epochs, batch_size):
+def get_batches(X, labels, ranges, idxs, batch_size, num_workers=1):
+    """Read and convert batches of rows to tensors in worker threads, ahead of the model.
+
+    Arguments:
+        X (dict): memory-mapped feature matrix output by load_encoded_mmap
+        labels (array of int): label of each row of X
+        ranges (tuple): starts and lengths of the row ranges of a split, see get_user_ranges
+        idxs (array of int): positions among the rows of the split, in batch order
+        batch_size (int)
+        num_workers (int): number of threads preparing batches
+
+    Output:
+        batches (generator): inputs and labels of each batch, see get_tensors
+    """
+    def get_batch(batch_idxs):
+        # Rows of a batch are independent, sorted rows are faster to read
+        rows = get_range_rows(*ranges, np.sort(batch_idxs))
+        inputs, batch_labels = get_tensors(get_rows(X, rows), labels[rows])
+        if torch.cuda.is_available():
+            inputs, batch_labels = [x.pin_memory() for x in inputs], batch_labels.pin_memory()
+        return inputs, batch_labels
+
+    return prefetch(get_batch, [idxs[k:k + batch_size] for k in range(0, len(idxs), batch_size)], num_workers)
+
+
+def train_ffw(X, labels, train, val, model, optimizer, logger, saver, num_epochs, batch_size, num_workers=1):
     """Train feedforward baseline.
 
     Arguments:
-        train (sparse matrix): output by encode.py
-        val (sparse matrix): output by encode.py
+        X (dict): memory-mapped feature matrix output by load_encoded_mmap
+        labels (array of int): label of each row of X
+        train (tuple): starts and lengths of training row ranges, see get_user_ranges
+        val (tuple): same for validation
         model (torch Module)
         optimizer (torch optimizer)
         logger: wrapper for TensorboardX logger
         saver: wrapper for torch saving
         num_epochs (int): number of epochs to train for
         batch_size (int)
+        num_workers (int): number of threads preparing batches
     """
     criterion = nn.BCEWithLogitsLoss()
     metrics = Metrics()
-    train_idxs = np.arange(train.shape[0])
-    val_idxs = np.arange(val.shape[0])
+    train_idxs = np.arange(train[1].sum())
+    val_idxs = np.arange(val[1].sum())
     step = 0
 
     for epoch in range(num_epochs):
@@ -42,19 +69,18 @@ def train_ffw(train, val, model, optimizer, logger, saver, num_epochs, batch_siz
         np.random.shuffle(val_idxs)
 
         # Training
-        for k in range(0, len(train_idxs), batch_size):
-            inputs, labels = get_tensors(train[train_idxs[k:k + batch_size]])
-            inputs = inputs.cuda()
-            preds = model(inputs).flatten()
-            loss = criterion(preds, labels.cuda())
-            train_auc = roc_auc_score(labels, torch.sigmoid(preds).detach().cpu())
+        for inputs, batch_labels in get_batches(X, labels, train, train_idxs, batch_size, num_workers):
+            inputs = [x.cuda(non_blocking=True) for x in inputs]
+            batch_labels = batch_labels.cuda(non_blocking=True)
+            preds = model(*inputs).flatten()
+            loss = criterion(preds, batch_labels)
 
             model.zero_grad()
             loss.backward()
             optimizer.step()
             step += 1
-            metrics.store({'loss/train': loss.item()})
-            metrics.store({'auc/train': train_auc})
+            metrics.store({'loss/train': loss.detach()})
+            metrics.store_predictions('train', torch.sigmoid(preds), batch_labels)
 
             # Logging
             if step % 20 == 0:
@@ -62,13 +88,11 @@ def train_ffw(train, val, model, optimizer, logger, saver, num_epochs, batch_siz
 
         # Validation
         model.eval()
-        for k in range(0, len(val_idxs), batch_size):
-            inputs, labels = get_tensors(val[val_idxs[k:k + batch_size]])
-            inputs = inputs.cuda()
+        for inputs, batch_labels in get_batches(X, labels, val, val_idxs, batch_size, num_workers):
+            inputs = [x.cuda(non_blocking=True) for x in inputs]
             with torch.no_grad():
-                preds = model(inputs).flatten()
-            val_auc = roc_auc_score(labels, torch.sigmoid(preds).cpu())
-            metrics.store({'auc/val': val_auc})
+                preds = model(*inputs).flatten()
+            metrics.store_predictions('val', torch.sigmoid(preds), batch_labels)
         model.train()
 
         # Save model
@@ -88,49 +112,52 @@ if __name__ == "__main__":
     parser.add_argument('--hid_size', type=int, default=500)
     parser.add_argument('--drop_prob', type=float, default=0.5)
     parser.add_argument('--batch_size', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of threads preparing batches ahead of training')
     parser.add_argument('--lr', type=float, default=1e-2)
     parser.add_argument('--num_epochs', type=int, default=30)
     args = parser.parse_args()
 
     features_suffix = (args.X_file.split("-")[-1]).split(".")[0]
 
-    # Load sparse dataset
-    X = csr_matrix(load_npz(args.X_file))
+    # Memory-map sparse dataset
+    X = load_encoded_mmap(args.X_file)
+    labels = load_columns(get_meta_path(args.X_file))["correct"]
 
-    train_df = pd.read_csv(f'data/{args.dataset}/preprocessed_data_train.csv', sep="\t")
-    test_df = pd.read_csv(f'data/{args.dataset}/preprocessed_data_test.csv', sep="\t")
+    data_path = os.path.join('data', args.dataset)
+    train_df = load_preprocessed(data_path, "train")
+    test_df = load_preprocessed(data_path, "test")
 
-    # Student-wise train-val-test split
-    user_ids = X[:, 0].toarray().flatten()
+    # Student-wise train-val-test split, selecting row ranges of users
+    offsets, users = load_encoded_user_offsets(args.X_file)
     users_test = test_df["user_id"].unique()
     users_train_val = train_df["user_id"].unique()
     split = int(0.8 * len(users_train_val))
     users_train, users_val = users_train_val[:split], users_train_val[split:]
-    train = X[np.where(np.isin(user_ids, users_train))]
-    val = X[np.where(np.isin(user_ids, users_val))]
-    test = X[np.where(np.isin(user_ids, users_test))]
+    train, val, test = [get_user_ranges(offsets, users, selected) for selected in (users_train, users_val, users_test)]
 
-    model = FeedForward(train.shape[1] - 5, args.hid_size, args.drop_prob).cuda()
+    model = FeedForward(X["shape"][1], args.hid_size, args.drop_prob).cuda()
     optimizer = Adam(model.parameters(), lr=args.lr)
 
     # Train
     param_str = f'{args.dataset}, features={features_suffix}'
     logger = Logger(os.path.join(args.logdir, param_str))
     saver = Saver(args.savedir, param_str)
-    train_ffw(train, val, model, optimizer, logger, saver, args.num_epochs, args.batch_size)
+    train_ffw(X, labels, train, val, model, optimizer, logger, saver, args.num_epochs, args.batch_size, args.workers)
     logger.close()
 
     model.eval()
     pred_test = np.zeros(len(test_df))
-    for k in range(0, test.shape[0], args.batch_size):
-        inputs, labels = get_tensors(test[k:k + args.batch_size])
-        inputs = inputs.cuda()
+    num_test = test[1].sum()
+    test_batches = get_batches(X, labels, test, np.arange(num_test), args.batch_size, args.workers)
+    for k, (inputs, _) in zip(range(0, num_test, args.batch_size), test_batches):
+        inputs = [x.cuda(non_blocking=True) for x in inputs]
         with torch.no_grad():
-            pred_test[k:k + args.batch_size] = torch.sigmoid(model(inputs)).flatten().cpu().numpy()
+            pred_test[k:k + args.batch_size] = torch.sigmoid(model(*inputs)).flatten().cpu().numpy()
 
     # Write predictions to csv
     test_df[f"FFW_{features_suffix}"] = pred_test
-    test_df.to_csv(f'data/{args.dataset}/preprocessed_data_test.csv', sep="\t", index=False)
+    save_preprocessed(test_df, data_path, "test")
 
     print("auc_test = ", roc_auc_score(test_df["correct"], pred_test))
 
@@ -1,10 +1,14 @@
+import os
 import argparse
 import numpy as np
-import pandas as pd
-from scipy.sparse import load_npz, csr_matrix
+from concurrent.futures import ThreadPoolExecutor
+from scipy.special import expit
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import roc_auc_score, accuracy_score, log_loss, brier_score_loss
 
+from utils.data import (expand_ranges, get_meta_path, get_range_rows, get_rows, get_user_ranges, load_columns,
+                        load_encoded_mmap, load_encoded_user_offsets, load_preprocessed, save_preprocessed)
+
 
 def compute_metrics(y_pred, y):
     acc = accuracy_score(y, np.round(y_pred))
@@ -14,42 +18,142 @@ def compute_metrics(y_pred, y):
     return acc, auc, nll, mse
 
 
+def read_block(X, ranges, start, stop):
+    """Read rows start to stop of the concatenated row ranges of a memory-mapped feature matrix.
+
+    Arguments:
+        X (dict): output by load_encoded_mmap
+        ranges (tuple): starts and lengths of row ranges, see get_user_ranges
+        start, stop (int): positions among the rows of all ranges
+
+    Output:
+        rows (array of int): rows of X read
+        block (sparse array): csr matrix of these rows
+    """
+    rows = get_range_rows(*ranges, np.arange(start, stop))
+    return rows, get_rows(X, rows)
+
+
+def compute_gradient(X, y, w, b, executor, workers):
+    """Gradient of the summed log-loss over a block, evaluated on row chunks in parallel.
+
+    Output:
+        grad_w (array of float): (num_features,) gradient of the weights
+        grad_b (float): gradient of the intercept
+    """
+    bounds = np.linspace(0, X.shape[0], workers + 1).astype(int)
+
+    def chunk_gradient(start, stop):
+        residuals = expit(X[start:stop] @ w + b) - y[start:stop]
+        return X[start:stop].T @ residuals, residuals.sum()
+
+    grads = list(executor.map(chunk_gradient, bounds[:-1], bounds[1:]))
+    return sum(g[0] for g in grads), sum(g[1] for g in grads)
+
+
+def train_minibatch(X, labels, ranges, C, num_epochs, block_size, lr, workers=1):
+    """Fit L2-regularized logistic regression with AdaGrad, streaming blocks of rows from disk.
+
+    The objective matches sklearn: C times the summed log-loss plus half the squared norm
+    of the weights, the intercept is not regularized.
+
+    Arguments:
+        X (dict): memory-mapped feature matrix output by load_encoded_mmap
+        labels (array of int): label of each row of X
+        ranges (tuple): starts and lengths of training row ranges, see get_user_ranges
+        C (float): inverse of regularization strength
+        num_epochs (int): number of passes over the training rows
+        block_size (int): number of rows per gradient step
+        lr (float): AdaGrad learning rate
+        workers (int): number of threads evaluating the gradient
+
+    Output:
+        w (array of float): (num_features,) weights
+        b (float): intercept
+    """
+    num_features = X["shape"][1]
+    w, b = np.zeros(num_features), 0.
+    sum_sq_w, sum_sq_b = np.zeros(num_features), 0.
+    num_rows = ranges[1].sum()
+    num_blocks = (num_rows + block_size - 1) // block_size
+
+    with ThreadPoolExecutor(workers) as executor:
+        for epoch in range(num_epochs):
+            # Shuffle blocks rather than rows to keep reads sequential
+            order = np.random.permutation(num_blocks)
+            for i in order:
+                block_rows, X_block = read_block(X, ranges, i * block_size, min((i + 1) * block_size, num_rows))
+                grad_w, grad_b = compute_gradient(X_block, labels[block_rows], w, b, executor, workers)
+
+                # Average loss over the block plus its share of the penalty
+                grad_w = grad_w / len(block_rows) + w / (C * num_rows)
+                grad_b = grad_b / len(block_rows)
+
+                sum_sq_w += grad_w ** 2
+                sum_sq_b += grad_b ** 2
+                w -= lr * grad_w / (np.sqrt(sum_sq_w) + 1e-8)
+                b -= lr * grad_b / (np.sqrt(sum_sq_b) + 1e-8)
+
+    return w, b
+
+
+def predict_minibatch(X, ranges, w, b, block_size):
+    """Predict probabilities of the rows in given ranges of a memory-mapped feature matrix by blocks."""
+    num_rows = ranges[1].sum()
+    return np.concatenate([expit(read_block(X, ranges, i, min(i + block_size, num_rows))[1] @ w + b)
+                           for i in range(0, num_rows, block_size)])
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Train logistic regression on sparse feature matrix.')
     parser.add_argument('--X_file', type=str)
     parser.add_argument('--dataset', type=str)
     parser.add_argument('--iter', type=int, default=1000)
+    parser.add_argument('--C', type=float, default=1.0,
+                        help='Inverse of L2 regularization strength.')
+    parser.add_argument('--minibatch', action='store_true',
+                        help='If True, stream blocks of rows from disk instead of fitting in memory.')
+    parser.add_argument('--num_epochs', type=int, default=10)
+    parser.add_argument('--block_size', type=int, default=10000)
+    parser.add_argument('--lr', type=float, default=0.1)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of threads evaluating minibatch gradients')
     args = parser.parse_args()
 
     features_suffix = (args.X_file.split("-")[-1]).split(".")[0]
 
-    # Load sparse dataset
-    X = csr_matrix(load_npz(args.X_file))
+    # Memory-map sparse dataset
+    X = load_encoded_mmap(args.X_file)
+    labels = load_columns(get_meta_path(args.X_file))["correct"]
 
-    train_df = pd.read_csv(f'data/{args.dataset}/preprocessed_data_train.csv', sep="\t")
-    test_df = pd.read_csv(f'data/{args.dataset}/preprocessed_data_test.csv', sep="\t")
+    data_path = os.path.join('data', args.dataset)
+    train_df = load_preprocessed(data_path, "train")
+    test_df = load_preprocessed(data_path, "test")
     
-    # Student-wise train-test split
-    user_ids = X[:, 0].toarray().flatten()
-    users_train = train_df["user_id"].unique()
-    users_test = test_df["user_id"].unique()
-    train = X[np.where(np.isin(user_ids, users_train))]
-    test = X[np.where(np.isin(user_ids, users_test))]
+    # Student-wise train-test split, selecting row ranges of users
+    offsets, users = load_encoded_user_offsets(args.X_file)
+    train = get_user_ranges(offsets, users, train_df["user_id"].unique())
+    test = get_user_ranges(offsets, users, test_df["user_id"].unique())
 
-    # First 5 columns are the original dataset, including label in column 3
-    X_train, y_train = train[:, 5:], train[:, 3].toarray().flatten()
-    X_test, y_test = test[:, 5:], test[:, 3].toarray().flatten()
+    y_train, y_test = labels[expand_ranges(*train)], labels[expand_ranges(*test)]
 
     # Train
-    model = LogisticRegression(solver="lbfgs", max_iter=args.iter)
-    model.fit(X_train, y_train)
+    if args.minibatch:
+        w, b = train_minibatch(X, labels, train, args.C, args.num_epochs, args.block_size, args.lr, args.workers)
+        y_pred_train = predict_minibatch(X, train, w, b, args.block_size)
+        y_pred_test = predict_minibatch(X, test, w, b, args.block_size)
+    else:
+        # Rows of each split are read once, lbfgs needs them in memory
+        X_train, X_test = get_rows(X, expand_ranges(*train)), get_rows(X, expand_ranges(*test))
+        model = LogisticRegression(solver="lbfgs", C=args.C, max_iter=args.iter)
+        model.fit(X_train, y_train)
 
-    y_pred_train = model.predict_proba(X_train)[:, 1]
-    y_pred_test = model.predict_proba(X_test)[:, 1]
+        y_pred_train = model.predict_proba(X_train)[:, 1]
+        y_pred_test = model.predict_proba(X_test)[:, 1]
 
     # Write predictions to csv
     test_df[f"LR_{features_suffix}"] = y_pred_test
-    test_df.to_csv(f'data/{args.dataset}/preprocessed_data_test.csv', sep="\t", index=False)
+    save_preprocessed(test_df, data_path, "test")
 
     acc_train, auc_train, nll_train, mse_train = compute_metrics(y_pred_train, y_train)
     acc_test, auc_test, nll_test, mse_test = compute_metrics(y_pred_test, y_test)
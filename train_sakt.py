@@ -1,88 +1,48 @@
 import argparse
-import pandas as pd
-from random import shuffle
-from sklearn.metrics import roc_auc_score, accuracy_score
+from sklearn.metrics import roc_auc_score
 
 import torch.nn as nn
 from torch.optim import Adam
 from torch.nn.utils import clip_grad_norm_
-from torch.nn.utils.rnn import pad_sequence
 
 from model_sakt import SAKT
 from utils import *
 
 
-def get_data(df, max_length, train_split=0.8, randomize=True):
+def get_data(df, max_length, train_split=0.8, randomize=True, offsets=None, pack=False):
     """Extract sequences from dataframe.
 
     Arguments:
         df (pandas Dataframe): output by prepare_data.py
         max_length (int): maximum length of a sequence chunk
         train_split (float): proportion of data to use for training
+        offsets (array of int): user sequence offsets output by prepare_data.py,
+            computed from df if None
+        pack (bool): if True, concatenate chunks of several users in each sequence
     """
-    item_ids = [torch.tensor(u_df["item_id"].values, dtype=torch.long)
-                for _, u_df in df.groupby("user_id")]
-    skill_ids = [torch.tensor(u_df["skill_id"].values, dtype=torch.long)
-                 for _, u_df in df.groupby("user_id")]
-    labels = [torch.tensor(u_df["correct"].values, dtype=torch.long)
-              for _, u_df in df.groupby("user_id")]
-
-    item_inputs = [torch.cat((torch.zeros(1, dtype=torch.long), i + 1))[:-1] for i in item_ids]
-    skill_inputs = [torch.cat((torch.zeros(1, dtype=torch.long), s + 1))[:-1] for s in skill_ids]
-    label_inputs = [torch.cat((torch.zeros(1, dtype=torch.long), l))[:-1] for l in labels]
-
-    def chunk(list):
-        if list[0] is None:
-            return list
-        list = [torch.split(elem, max_length) for elem in list]
-        return [elem for sublist in list for elem in sublist]
+    if offsets is None:
+        offsets = get_user_offsets(df["user_id"].values)
 
-    # Chunk sequences
-    lists = (item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, labels)
-    chunked_lists = [chunk(l) for l in lists]
-
-    data = list(zip(*chunked_lists))
-    if randomize:
-        shuffle(data)
-
-    # Train-test split across users
-    train_size = int(train_split * len(data))
-    train_data, val_data = data[:train_size], data[train_size:]
-    return train_data, val_data
+    item_ids = torch.tensor(df["item_id"].values, dtype=torch.int)
+    skill_ids = torch.tensor(df["skill_id"].values, dtype=torch.int)
+    labels = torch.tensor(df["correct"].values, dtype=torch.int)
 
+    # Shift inputs by one interaction within each sequence
+    shifted = [torch.cat((torch.zeros(1, dtype=torch.int), x[:-1])) for x in (item_ids + 1, skill_ids + 1, labels)]
+    for x in shifted:
+        x[offsets[:-1]] = 0
 
-def prepare_batches(data, batch_size, randomize=True):
-    """Prepare batches grouping padded sequences.
-
-    Arguments:
-        data (list of lists of torch Tensor): output by get_data
-        batch_size (int): number of sequences per batch
-    Output:
-        batches (list of lists of torch Tensor)
-    """
-    if randomize:
-        shuffle(data)
-    batches = []
-
-    for k in range(0, len(data), batch_size):
-        batch = data[k:k + batch_size]
-        seq_lists = list(zip(*batch))
-        inputs_and_ids = [pad_sequence(seqs, batch_first=True, padding_value=0)
-                          if (seqs[0] is not None) else None for seqs in seq_lists[:-1]]
-        labels = pad_sequence(seq_lists[-1], batch_first=True, padding_value=-1)  # Pad labels with -1
-        batches.append([*inputs_and_ids, labels])
-
-    return batches
+    # Chunk sequences
+    data = SequenceDataset.from_offsets([*shifted, item_ids, skill_ids, labels, None], offsets,
+                                        pad_values=[0, 0, 0, 0, 0, -1, -1],  # Pad labels with -1
+                                        max_length=max_length)
 
+    # Last field holds the chunk of each interaction when packing
+    if pack:
+        data = data.pack(max_length, segment_field=-1)
 
-def compute_auc(preds, labels):
-    preds = preds[labels >= 0].flatten()
-    labels = labels[labels >= 0].float()
-    if len(torch.unique(labels)) == 1:  # Only one class
-        auc = accuracy_score(labels, preds.round())
-    else:
-        auc = roc_auc_score(labels, preds)
-    return auc
+    # Train-test split across users
+    return data.split(train_split, randomize)
 
 
 def compute_loss(preds, labels, criterion):
@@ -91,12 +51,12 @@ def compute_loss(preds, labels, criterion):
     return criterion(preds, labels)
 
 
-def train(train_data, val_data, model, optimizer, logger, saver, num_epochs, batch_size, grad_clip):
+def train(train_data, val_data, model, optimizer, logger, saver, num_epochs, batch_size, grad_clip, bucket_size=None):
     """Train SAKT model.
 
     Arguments:
-        train_data (list of tuples of torch Tensor)
-        val_data (list of tuples of torch Tensor)
+        train_data (SequenceDataset)
+        val_data (SequenceDataset)
         model (torch Module)
         optimizer (torch optimizer)
         logger: wrapper for TensorboardX logger
@@ -104,35 +64,37 @@ def train(train_data, val_data, model, optimizer, logger, saver, num_epochs, bat
         num_epochs (int): number of epochs to train for
         batch_size (int)
         grad_clip (float): max norm of the gradients
+        bucket_size (int): if not None, batch sequences of similar lengths, see SequenceDataset.batches
     """
     criterion = nn.BCEWithLogitsLoss()
     metrics = Metrics()
     step = 0
 
     for epoch in range(num_epochs):
-        train_batches = prepare_batches(train_data, batch_size)
-        val_batches = prepare_batches(val_data, batch_size)
+        train_batches = train_data.batches(batch_size, bucket_size=bucket_size)
+        val_batches = val_data.batches(batch_size, bucket_size=bucket_size)
 
         # Training
-        for item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, labels in train_batches:
+        for item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, labels, segments in train_batches:
             item_inputs = item_inputs.cuda()
             skill_inputs = skill_inputs.cuda()
             label_inputs = label_inputs.cuda()
             item_ids = item_ids.cuda()
             skill_ids = skill_ids.cuda()
+            segments = segments.cuda() if segments is not None else None
+            labels = labels.cuda()
 
-            preds = model(item_inputs, skill_inputs, label_inputs, item_ids, skill_ids)
-            loss = compute_loss(preds, labels.cuda(), criterion)
-            preds = torch.sigmoid(preds).detach().cpu()
-            train_auc = compute_auc(preds, labels)
+            preds = model(item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, segments)
+            loss = compute_loss(preds, labels, criterion)
 
             model.zero_grad()
             loss.backward()
             clip_grad_norm_(model.parameters(), grad_clip)
             optimizer.step()
             step += 1
-            metrics.store({'loss/train': loss.item()})
-            metrics.store({'auc/train': train_auc})
+            metrics.store({'loss/train': loss.detach()})
+            metrics.store({'padding_efficiency/train': (labels >= 0).float().mean()})
+            metrics.store_predictions('train', torch.sigmoid(preds), labels)
 
             # Logging
             if step % 20 == 0:
@@ -145,17 +107,16 @@ def train(train_data, val_data, model, optimizer, logger, saver, num_epochs, bat
 
         # Validation
         model.eval()
-        for item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, labels in val_batches:
+        for item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, labels, segments in val_batches:
             item_inputs = item_inputs.cuda()
             skill_inputs = skill_inputs.cuda()
             label_inputs = label_inputs.cuda()
             item_ids = item_ids.cuda()
             skill_ids = skill_ids.cuda()
+            segments = segments.cuda() if segments is not None else None
             with torch.no_grad():
-                preds = model(item_inputs, skill_inputs, label_inputs, item_ids, skill_ids)
-                preds = torch.sigmoid(preds).cpu()
-            val_auc = compute_auc(preds, labels)
-            metrics.store({'auc/val': val_auc})
+                preds = model(item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, segments)
+            metrics.store_predictions('val', torch.sigmoid(preds), labels)
         model.train()
 
         # Save model
@@ -179,16 +140,22 @@ if __name__ == "__main__":
     parser.add_argument('--max_pos', type=int, default=10)
     parser.add_argument('--drop_prob', type=float, default=0.2)
     parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--bucket_size', type=int, default=None,
+                        help='number of batches per length-sorted pool, no bucketing if not set')
+    parser.add_argument('--pack', action='store_true',
+                        help='If True, concatenate chunks of several users in each sequence.')
     parser.add_argument('--lr', type=float, default=1e-3)
     parser.add_argument('--grad_clip', type=float, default=10)
     parser.add_argument('--num_epochs', type=int, default=300)
     args = parser.parse_args()
 
-    full_df = pd.read_csv(os.path.join('data', args.dataset, 'preprocessed_data.csv'), sep="\t")
-    train_df = pd.read_csv(os.path.join('data', args.dataset, 'preprocessed_data_train.csv'), sep="\t")
-    test_df = pd.read_csv(os.path.join('data', args.dataset, 'preprocessed_data_test.csv'), sep="\t")
+    data_path = os.path.join('data', args.dataset)
+    full_df = load_preprocessed(data_path)
+    train_df = load_preprocessed(data_path, "train")
+    test_df = load_preprocessed(data_path, "test")
 
-    train_data, val_data = get_data(train_df, args.max_length)
+    train_data, val_data = get_data(train_df, args.max_length, offsets=load_user_offsets(data_path, "train"),
+                                    pack=args.pack)
 
     num_items = int(full_df["item_id"].max() + 1)
     num_skills = int(full_df["skill_id"].max() + 1)
@@ -204,12 +171,13 @@ if __name__ == "__main__":
             param_str = (f'{args.dataset},'
                          f'batch_size={args.batch_size},'
                          f'max_length={args.max_length},'
+                         f'pack={args.pack},'
                          f'encode_pos={args.encode_pos},'
                          f'max_pos={args.max_pos}')
             logger = Logger(os.path.join(args.logdir, param_str))
             saver = Saver(args.savedir, param_str)
             train(train_data, val_data, model, optimizer, logger, saver, args.num_epochs,
-                  args.batch_size, args.grad_clip)
+                  args.batch_size, args.grad_clip, args.bucket_size)
             break
         except RuntimeError:
             args.batch_size = args.batch_size // 2
@@ -217,25 +185,27 @@ if __name__ == "__main__":
 
     logger.close()
 
-    test_data, _ = get_data(test_df, args.max_length, train_split=1.0, randomize=False)
-    test_batches = prepare_batches(test_data, args.batch_size, randomize=False)
+    test_data, _ = get_data(test_df, args.max_length, train_split=1.0, randomize=False,
+                            offsets=load_user_offsets(data_path, "test"), pack=args.pack)
+    test_batches = test_data.batches(args.batch_size, randomize=False)
     test_preds = np.empty(0)
 
     # Predict on test set
     model.eval()
-    for item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, labels in test_batches:
+    for item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, labels, segments in test_batches:
         item_inputs = item_inputs.cuda()
         skill_inputs = skill_inputs.cuda()
         label_inputs = label_inputs.cuda()
         item_ids = item_ids.cuda()
         skill_ids = skill_ids.cuda()
+        segments = segments.cuda() if segments is not None else None
         with torch.no_grad():
-            preds = model(item_inputs, skill_inputs, label_inputs, item_ids, skill_ids)
+            preds = model(item_inputs, skill_inputs, label_inputs, item_ids, skill_ids, segments)
             preds = torch.sigmoid(preds[labels >= 0]).flatten().cpu().numpy()
             test_preds = np.concatenate([test_preds, preds])
 
     # Write predictions to csv
     test_df["SAKT"] = test_preds
-    test_df.to_csv(f'data/{args.dataset}/preprocessed_data_test.csv', sep="\t", index=False)
+    save_preprocessed(test_df, data_path, "test")
 
     print("auc_test = ", roc_auc_score(test_df["correct"], test_preds))
@@ -1,4 +1,6 @@
 from .logger import *
 from .saver import *
 from .metrics import *
-from .misc import *
\ No newline at end of file
+from .misc import *
+from .data import *
+from .sequences import *
\ No newline at end of file
@@ -0,0 +1,285 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+# Typed storage for the columns written by prepare_data.py, other columns keep their dtype
+COLUMN_DTYPES = {
+    "user_id": np.int32,
+    "item_id": np.int32,
+    "timestamp": np.int64,
+    "correct": np.int8,
+    "skill_id": np.int32,
+}
+
+
+def get_data_file(data_path, split=None):
+    """Return preprocessed data path without extension.
+
+    Arguments:
+        data_path (str): dataset folder, e.g. data/assistments09
+        split (str): None for the full dataset, "train" or "test"
+    """
+    name = "preprocessed_data" if split is None else f"preprocessed_data_{split}"
+    return os.path.join(data_path, name)
+
+
+def get_user_offsets(user_ids):
+    """Compute CSR-style offsets of user sequences in data sorted by user.
+
+    Arguments:
+        user_ids (array of int): user of each interaction, contiguous per user
+
+    Output:
+        offsets (array of int): sequence k spans rows offsets[k] to offsets[k + 1]
+    """
+    user_ids = np.asarray(user_ids)
+    starts = np.flatnonzero(np.r_[True, user_ids[1:] != user_ids[:-1]]) if len(user_ids) else []
+    return np.r_[starts, len(user_ids)].astype(np.int64)
+
+
+def expand_ranges(starts, lengths):
+    """Concatenate the integer ranges starts[k] to starts[k] + lengths[k]."""
+    return np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+
+
+def get_user_ranges(offsets, users, selected_users):
+    """Row ranges of the selected users in data contiguous per user.
+
+    Arguments:
+        offsets (array of int): see get_user_offsets
+        users (array of int): user of each sequence
+        selected_users (array of int)
+
+    Output:
+        starts, lengths (arrays of int): first row and number of rows of each selected
+            user, in data order
+    """
+    idxs = np.flatnonzero(np.isin(users, selected_users))
+    return offsets[idxs], offsets[idxs + 1] - offsets[idxs]
+
+
+def get_range_rows(starts, lengths, positions):
+    """Rows at given positions of the concatenation of row ranges, without expanding it.
+
+    Arguments:
+        starts, lengths (arrays of int): row ranges, see get_user_ranges
+        positions (array of int): positions among the rows of all ranges
+
+    Output:
+        rows (array of int)
+    """
+    ends = np.cumsum(lengths)
+    idxs = np.searchsorted(ends, positions, side="right")
+    return starts[idxs] + positions - (ends[idxs] - lengths[idxs])
+
+
+def save_user_offsets(path, user_ids):
+    """Save offsets of user sequences next to the column arrays, see get_user_offsets."""
+    np.save(os.path.join(path, "user_offsets.npy"), get_user_offsets(user_ids))
+
+
+def save_columns(df, path):
+    """Save dataframe as a folder of memory-mappable .npy column arrays.
+
+    Arguments:
+        df (pandas DataFrame): data to save
+        path (str): output folder
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    for col in df.columns:
+        values = df[col].values
+        if col in COLUMN_DTYPES:
+            values = values.astype(COLUMN_DTYPES[col])
+        # Write then rename, df may hold memory-mapped columns of the file being replaced
+        np.save(os.path.join(path, f"{col}.tmp.npy"), values)
+        os.replace(os.path.join(path, f"{col}.tmp.npy"), os.path.join(path, f"{col}.npy"))
+
+    with open(os.path.join(path, "columns.txt"), "w") as f:
+        f.write("\n".join(df.columns))
+
+    if "user_id" in df:
+        save_user_offsets(path, df["user_id"].values)
+
+
+def load_columns(path, mmap_mode="r"):
+    """Load column arrays saved by save_columns.
+
+    Arguments:
+        path (str): folder written by save_columns
+        mmap_mode (str): numpy memory-map mode, None to read arrays in memory
+
+    Output:
+        columns (dict of numpy array): column name to array, in saved order
+    """
+    with open(os.path.join(path, "columns.txt")) as f:
+        names = f.read().split("\n")
+    return {col: np.load(os.path.join(path, f"{col}.npy"), mmap_mode=mmap_mode) for col in names}
+
+
+def save_preprocessed(df, data_path, split=None):
+    """Save preprocessed data both as tab-separated csv and as columnar arrays.
+
+    Arguments:
+        df (pandas DataFrame): preprocessed data
+        data_path (str): dataset folder
+        split (str): None for the full dataset, "train" or "test"
+    """
+    path = get_data_file(data_path, split)
+    df.to_csv(path + ".csv", sep="\t", index=False)
+    save_columns(df, path)
+
+
+def load_preprocessed(data_path, split=None):
+    """Load preprocessed data, from columnar arrays if available, else from csv.
+
+    Arguments:
+        data_path (str): dataset folder
+        split (str): None for the full dataset, "train" or "test"
+
+    Output:
+        df (pandas DataFrame): columns are memory-mapped when loaded from arrays
+    """
+    path = get_data_file(data_path, split)
+    if os.path.exists(os.path.join(path, "columns.txt")):
+        return pd.DataFrame(load_columns(path), copy=False)
+    return pd.read_csv(path + ".csv", sep="\t")
+
+
+def load_user_offsets(data_path, split=None):
+    """Load offsets of user sequences, computed from the data if they were not saved.
+
+    Arguments:
+        data_path (str): dataset folder
+        split (str): None for the full dataset, "train" or "test"
+
+    Output:
+        offsets (array of int): see get_user_offsets
+    """
+    path = os.path.join(get_data_file(data_path, split), "user_offsets.npy")
+    if os.path.exists(path):
+        return np.load(path)
+    return get_user_offsets(load_preprocessed(data_path, split)["user_id"].values)
+
+
+def get_meta_path(X_file):
+    """Folder of the columns describing the rows of a feature matrix saved by encode.py."""
+    return os.path.splitext(X_file)[0] + "_meta"
+
+
+def get_csr_path(X_file):
+    """Folder of the uncompressed csr arrays of a feature matrix saved by encode.py."""
+    return os.path.splitext(X_file)[0] + "_csr"
+
+
+def save_encoded(X, meta, X_file, column_blocks=None):
+    """Save feature matrix and the columnar metadata of its rows, with user offsets.
+
+    The csr arrays of X are also saved uncompressed, so that blocks of rows can be read
+    from disk without loading the whole matrix, see load_encoded_mmap.
+
+    Arguments:
+        X (sparse array): csr feature matrix output by encode.py
+        meta (pandas DataFrame): user_id, item_id, timestamp, correct and skill_id of each row
+        X_file (str): .npz path of the feature matrix
+        column_blocks (pandas DataFrame): if not None, name, start and stop column of each
+            feature block of X, saved next to the metadata
+    """
+    sparse.save_npz(X_file, X)
+    save_columns(meta, get_meta_path(X_file))
+    if column_blocks is not None:
+        column_blocks.to_csv(os.path.join(get_meta_path(X_file), "column_blocks.csv"), sep="\t", index=False)
+
+    path = get_csr_path(X_file)
+    os.makedirs(path, exist_ok=True)
+    for name in ("data", "indices", "indptr"):
+        np.save(os.path.join(path, f"{name}.npy"), getattr(X, name))
+    np.save(os.path.join(path, "shape.npy"), np.array(X.shape, dtype=np.int64))
+
+
+def load_encoded(X_file):
+    """Load feature matrix saved by save_encoded.
+
+    Output:
+        X (sparse array): csr feature matrix
+        meta (pandas DataFrame): memory-mapped metadata of the rows of X
+    """
+    X = sparse.load_npz(X_file).tocsr()
+    meta = pd.DataFrame(load_columns(get_meta_path(X_file)), copy=False)
+    return X, meta
+
+
+def load_encoded_mmap(X_file):
+    """Memory-map the csr arrays of a feature matrix saved by save_encoded.
+
+    Output:
+        X (dict): memory-mapped data, indices and indptr arrays and shape of the matrix,
+            rows are read with get_rows
+    """
+    path = get_csr_path(X_file)
+    X = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ("data", "indices", "indptr")}
+    X["shape"] = tuple(np.load(os.path.join(path, "shape.npy")))
+    return X
+
+
+def get_rows(X, rows):
+    """Read rows of a memory-mapped feature matrix, at a cost linear in their nonzeros.
+
+    Arguments:
+        X (dict): output by load_encoded_mmap
+        rows (array of int)
+
+    Output:
+        block (sparse array): csr matrix of shape (len(rows), num_features)
+    """
+    starts = np.asarray(X["indptr"][rows])
+    lengths = np.asarray(X["indptr"][rows + 1]) - starts
+    nonzeros = expand_ranges(starts, lengths)
+    indptr = np.r_[0, np.cumsum(lengths)]
+    return sparse.csr_matrix((X["data"][nonzeros], X["indices"][nonzeros], indptr), shape=(len(rows), X["shape"][1]))
+
+
+def load_column_blocks(X_file):
+    """Load name, start and stop column of each feature block of a matrix saved by save_encoded."""
+    return pd.read_csv(os.path.join(get_meta_path(X_file), "column_blocks.csv"), sep="\t")
+
+
+def load_encoded_user_offsets(X_file):
+    """Load offsets of user sequences in a feature matrix saved by save_encoded.
+
+    Output:
+        offsets (array of int): see get_user_offsets
+        users (array of int): user of each sequence
+    """
+    path = get_meta_path(X_file)
+    user_ids = np.load(os.path.join(path, "user_id.npy"), mmap_mode="r")
+    if os.path.exists(os.path.join(path, "user_offsets.npy")):
+        offsets = np.load(os.path.join(path, "user_offsets.npy"))
+    else:
+        offsets = get_user_offsets(user_ids)
+    return offsets, np.asarray(user_ids[offsets[:-1]])
+
+
+def create_columns(path, num_rows, names):
+    """Create writable memory-mapped column arrays, to be filled in place.
+
+    Arguments:
+        path (str): output folder, readable by load_columns once filled
+        num_rows (int): length of every column
+        names (list of str): column names, typed according to COLUMN_DTYPES
+
+    Output:
+        columns (dict of numpy memmap)
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    with open(os.path.join(path, "columns.txt"), "w") as f:
+        f.write("\n".join(names))
+
+    return {col: np.lib.format.open_memmap(os.path.join(path, f"{col}.npy"), mode="w+",
+                                           dtype=COLUMN_DTYPES[col], shape=(num_rows,))
+            for col in names}
@@ -1,9 +1,19 @@
 class Metrics:
     """Keep track of metrics over time in a dictionary.
+
+    Scalars can be stored as tensors and predictions are accumulated in histograms on their
+    device, so nothing is copied to the host until average is called.
     """
-    def __init__(self):
+    def __init__(self, num_bins=10000):
+        """
+        Arguments:
+            num_bins (int): number of probability bins of the prediction histograms, the AUC is
+                exact up to ties between predictions falling in the same bin
+        """
+        self.num_bins = num_bins
         self.metrics = {}
         self.counts = {}
+        self.predictions = {}
 
     def store(self, new_metrics):
         for key in new_metrics:
@@ -14,7 +24,63 @@ class Metrics:
                 self.metrics[key] = new_metrics[key]
                 self.counts[key] = 1
 
+    def store_predictions(self, split, preds, labels):
+        """Accumulate predictions to compute AUC, log-loss, accuracy and Brier score.
+
+        Arguments:
+            split (str): name used as metric suffix, e.g. "train" gives "auc/train"
+            preds (torch Tensor): predicted probabilities
+            labels (torch Tensor): same shape as preds, entries other than 0 or 1 are ignored
+        """
+        preds = preds.detach().flatten().double()
+        labels = labels.flatten().to(preds.device)
+        pos, neg = (labels == 1).double(), (labels == 0).double()
+
+        if split not in self.predictions:
+            self.predictions[split] = {
+                "pos": preds.new_zeros(self.num_bins),
+                "neg": preds.new_zeros(self.num_bins),
+                "log_loss": preds.new_zeros(()),
+                "brier": preds.new_zeros(()),
+                "correct": preds.new_zeros(()),
+            }
+        stats = self.predictions[split]
+
+        bins = (preds * self.num_bins).long().clamp(0, self.num_bins - 1)
+        stats["pos"].index_add_(0, bins, pos)
+        stats["neg"].index_add_(0, bins, neg)
+
+        probs = preds.clamp(1e-7, 1 - 1e-7)
+        stats["log_loss"] -= (pos * probs.log() + neg * (1 - probs).log()).sum()
+        stats["brier"] += (pos * (1 - preds) ** 2 + neg * preds ** 2).sum()
+        stats["correct"] += (pos * (preds > 0.5).double() + neg * (preds <= 0.5).double()).sum()
+
     def average(self):
-        average = {k: v / self.counts[k] for k, v in self.metrics.items()}
-        self.metrics, self.counts = {}, {}
-        return average
\ No newline at end of file
+        average = {k: float(v / self.counts[k]) for k, v in self.metrics.items()}
+        for split, stats in self.predictions.items():
+            average.update(compute_histogram_metrics(split, **stats))
+        self.metrics, self.counts, self.predictions = {}, {}, {}
+        return average
+
+
+def compute_histogram_metrics(split, pos, neg, log_loss, brier, correct):
+    """Compute metrics from the statistics accumulated by Metrics.store_predictions.
+
+    Output:
+        metrics (dict): auc, log_loss, accuracy and brier values suffixed by split
+    """
+    num_pos, num_neg = pos.sum(), neg.sum()
+    count = (num_pos + num_neg).clamp(min=1)
+    accuracy = float(correct / count)
+
+    if (num_pos == 0) or (num_neg == 0):  # Only one class
+        auc = accuracy
+    else:
+        # Pairs ranked correctly, ties within a bin count for one half
+        neg_below = neg.cumsum(0) - neg
+        auc = float((pos * (neg_below + neg / 2)).sum() / (num_pos * num_neg))
+
+    return {f'auc/{split}': auc,
+            f'log_loss/{split}': float(log_loss / count),
+            f'accuracy/{split}': accuracy,
+            f'brier/{split}': float(brier / count)}
@@ -1,8 +1,29 @@
 import torch
 import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 def set_random_seeds(seed):
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
     random.seed(seed)
+
+
+def prefetch(get_batch, batch_args, num_workers=1, max_prefetch=4):
+    """Compute batches ahead of their use in worker threads, yielding them in order.
+
+    Arguments:
+        get_batch (function): prepares one batch from its arguments
+        batch_args (iterable): arguments of each batch
+        num_workers (int): number of threads preparing batches
+        max_prefetch (int): maximum number of batches prepared ahead of the consumer
+    """
+    with ThreadPoolExecutor(num_workers) as executor:
+        futures = deque()
+        for args in batch_args:
+            if len(futures) == max_prefetch:
+                yield futures.popleft().result()
+            futures.append(executor.submit(get_batch, args))
+        while futures:
+            yield futures.popleft().result()
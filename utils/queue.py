@@ -1,27 +1,43 @@
+from collections import deque
+
+
 class TimeWindowQueue:
     """A queue for counting efficiently the number of events within time windows.
     Complexity:
         All operators in amortized O(W) time where W is the number of windows.
 
+    Timestamps older than the longest window are dropped and cursors only move forward, so memory
+    is bounded by the number of events within the longest window, for increasing times. The total
+    number of pushed events is counted separately and still returned by len and get_counters.
+
     From JJ's KTM repository: https://github.com/jilljenn/ktm.
     """
     def __init__(self, window_lengths):
-        self.queue = []
+        self.queue = deque()
         self.window_lengths = window_lengths
         self.cursors = [0] * len(self.window_lengths)
+        self.num_events = 0
 
     def __len__(self):
-        return len(self.queue)
+        return self.num_events
 
     def get_counters(self, t):
+        """Total number of events, followed by the number of events within each time window before t."""
         self.update_cursors(t)
-        return [len(self.queue)] + [len(self.queue) - cursor for cursor in self.cursors]
+        return [self.num_events] + [len(self.queue) - cursor for cursor in self.cursors]
 
     def push(self, time):
         self.queue.append(time)
+        self.num_events += 1
 
     def update_cursors(self, t):
         for pos, length in enumerate(self.window_lengths):
             while (self.cursors[pos] < len(self.queue) and
                    t - self.queue[self.cursors[pos]] >= length):
                 self.cursors[pos] += 1
+
+        # Forget events that are out of every window
+        start = min(self.cursors)
+        for _ in range(start):
+            self.queue.popleft()
+        self.cursors = [cursor - start for cursor in self.cursors]
@@ -1,4 +1,5 @@
 import os
+import inspect
 import torch
 import numpy as np
 
@@ -38,4 +39,8 @@ class Saver:
         return stop
 
     def load(self):
+        # Whole modules are pickled, see DKT1.__setstate__ for models saved with older layouts.
+        # Recent torch versions only load weights by default, older ones lack the argument
+        if "weights_only" in inspect.signature(torch.load).parameters:
+            return torch.load(self.path, weights_only=False)
         return torch.load(self.path)
@@ -0,0 +1,133 @@
+import numpy as np
+import torch
+
+
+class SequenceDataset:
+    """Variable length sequences stored back to back in flat tensors.
+
+    Each field holds all sequences in one flat int32 tensor and a sequence is a (start, length)
+    range into it. Shuffling and splitting only permute these ranges, and padded batches are
+    built lazily by gathering rows, so memory stays proportional to the number of interactions.
+    """
+    def __init__(self, fields, starts, lengths, pad_values=None):
+        """
+        Arguments:
+            fields (list of torch Tensor): flat tensors, None for fields that are not used
+            starts (torch Tensor): start of each sequence in the flat tensors
+            lengths (torch Tensor): length of each sequence
+            pad_values (list of int): padding value of each field, 0 if None
+        """
+        self.fields = [field.int() if field is not None else None for field in fields]
+        self.starts = torch.as_tensor(starts, dtype=torch.long)
+        self.lengths = torch.as_tensor(lengths, dtype=torch.long)
+        self.pad_values = pad_values if pad_values is not None else [0] * len(fields)
+
+    @classmethod
+    def from_offsets(cls, fields, offsets, pad_values=None, max_length=None):
+        """Build dataset from CSR-style offsets, see utils.data.get_user_offsets.
+
+        Arguments:
+            fields (list of torch Tensor): flat tensors, None for fields that are not used
+            offsets (array of int): sequence k spans offsets[k] to offsets[k + 1]
+            pad_values (list of int): padding value of each field, 0 if None
+            max_length (int): if not None, split sequences into chunks of at most max_length
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        starts, lengths = offsets[:-1], np.diff(offsets)
+        if max_length is not None:
+            num_chunks = (lengths + max_length - 1) // max_length
+            chunk_ranks = np.arange(num_chunks.sum()) - np.repeat(np.cumsum(num_chunks) - num_chunks, num_chunks)
+            chunk_starts = np.repeat(starts, num_chunks) + chunk_ranks * max_length
+            lengths = np.minimum(np.repeat(starts + lengths, num_chunks) - chunk_starts, max_length)
+            starts = chunk_starts
+        return cls(fields, torch.from_numpy(starts), torch.from_numpy(lengths), pad_values)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def subset(self, idxs):
+        """Dataset of the sequences at idxs, sharing the flat tensors."""
+        return SequenceDataset(self.fields, self.starts[idxs], self.lengths[idxs], self.pad_values)
+
+    def split(self, train_split, randomize=True):
+        """Split sequences into two datasets.
+
+        Arguments:
+            train_split (float): proportion of sequences in the first dataset
+            randomize (bool): if True, shuffle sequences before splitting
+        """
+        idxs = torch.randperm(len(self)) if randomize else torch.arange(len(self))
+        train_size = int(train_split * len(self))
+        return self.subset(idxs[:train_size]), self.subset(idxs[train_size:])
+
+    def pack(self, max_length, segment_field):
+        """Merge consecutive sequences into rows of at most max_length interactions.
+
+        Sequences must be stored back to back, as built by from_offsets, so that each row is still
+        a contiguous range of the flat tensors.
+
+        Arguments:
+            max_length (int): maximum number of interactions per row
+            segment_field (int): index of the field to fill with the sequence of each interaction,
+                padded with -1, so that models can keep the sequences of a row separate
+        """
+        assert torch.equal(self.starts[1:], self.starts[:-1] + self.lengths[:-1])
+
+        # Greedily fill rows in storage order
+        row_starts, row_lengths = [], []
+        for start, length in zip(self.starts.tolist(), self.lengths.tolist()):
+            if row_lengths and row_lengths[-1] + length <= max_length:
+                row_lengths[-1] += length
+            else:
+                row_starts.append(start)
+                row_lengths.append(length)
+
+        num_rows = len(next(field for field in self.fields if field is not None))
+        segments = torch.zeros(num_rows, dtype=torch.int)
+        segments[self.starts[1:]] = 1
+        fields, pad_values = list(self.fields), list(self.pad_values)
+        fields[segment_field], pad_values[segment_field] = segments.cumsum(0), -1
+        return SequenceDataset(fields, row_starts, row_lengths, pad_values)
+
+    def get_batch(self, idxs):
+        """Gather padded sequences.
+
+        Arguments:
+            idxs (torch Tensor): indices of the sequences in the batch
+
+        Output:
+            batch (list of torch Tensor): one (batch_size, max_length) long tensor per field
+        """
+        starts, lengths = self.starts[idxs], self.lengths[idxs]
+        positions = torch.arange(int(lengths.max()))
+        padding = positions.unsqueeze(0) >= lengths.unsqueeze(1)
+        rows = (starts.unsqueeze(1) + positions).masked_fill(padding, 0)
+
+        batch = []
+        for field, pad_value in zip(self.fields, self.pad_values):
+            if field is None:
+                batch.append(None)
+            else:
+                batch.append(field[rows].long().masked_fill(padding, pad_value))
+        return batch
+
+    def batches(self, batch_size, randomize=True, bucket_size=None):
+        """Iterate over padded batches, built only when requested.
+
+        Arguments:
+            batch_size (int): number of sequences per batch
+            randomize (bool): if True, shuffle sequences
+            bucket_size (int): if not None, sort sequences by length within pools of
+                bucket_size batches to reduce padding, batch order is shuffled if randomize
+        """
+        idxs = torch.randperm(len(self)) if randomize else torch.arange(len(self))
+        if bucket_size is not None:
+            pools = idxs.split(batch_size * bucket_size)
+            idxs = torch.cat([pool[self.lengths[pool].argsort(descending=True)] for pool in pools])
+
+        batch_idxs = idxs.split(batch_size)
+        if bucket_size is not None and randomize:
+            batch_idxs = [batch_idxs[k] for k in torch.randperm(len(batch_idxs))]
+
+        for idxs in batch_idxs:
+            yield self.get_batch(idxs)